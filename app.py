@@ -3,36 +3,756 @@ Lightweight blog application with hashed user authentication and secure token ve
 Users can register and login to their accounts to create blog posts. Blog posts belonging to them are able to be
 edited and deleted. Only required data persists through the user session.
 '''
+import os
+import atexit
+import bisect
+import csv
+import gzip
+import io
+import json
+import hashlib
+import logging
+import mimetypes
+import queue
+import re
+import sys
+import zlib
+import heapq
 import time
-from datetime import datetime,timedelta
+import threading
+import math
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date,datetime,timedelta,timezone
 from functools import wraps
+from logging.handlers import QueueHandler, QueueListener
+from itertools import chain, cycle
+from typing import NamedTuple
 import secrets
-from flask import Flask, redirect, render_template, request, url_for,session
+import click
+from flask import Blueprint, Flask, Response, current_app, g, redirect, render_template, request, url_for,session
+from flask import has_app_context, has_request_context, make_response, send_from_directory, stream_with_context
+from flask.cli import AppGroup
+from flask.sessions import SecureCookieSessionInterface
+from itsdangerous import URLSafeTimedSerializer
+from jinja2 import Template
 from werkzeug import exceptions as werkzeug_exceptions
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
 import jwt
 import bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import bindparam, cast, create_engine, event, func, or_, orm, text, tuple_
+from sqlalchemy import exc as sqlalchemy_exceptions
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION, TSVECTOR
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 from psycopg2 import IntegrityError
+import bulk
+import migrations
+try:
+    import brotli
+except(ImportError):
+    # Optional, assets are only precompressed with gzip without it
+    brotli = None
 
 #APP CONFIG
-app = Flask(__name__)
-app.config['SECRET_KEY']= secrets.token_urlsafe(12)
-app.config['SQLALCHEMY_DATABASE_URI']='postgresql://postgres:blog-user@db/blog'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS']= False
+# Defaults of every application made by create_app, the config passed to create_app overrides them
+DEFAULT_CONFIG = {
+    # Shared by every worker and replica. When unset each process makes up its own key
+    'SECRET_KEY':None,
+    # Previous keys, still accepted when verifying cookies and tokens but never used to sign
+    'SECRET_KEY_FALLBACKS':(),
+    'SQLALCHEMY_DATABASE_URI':'postgresql://postgres:blog-user@db/blog',
+    'SQLALCHEMY_TRACK_MODIFICATIONS':False,
+    'FEED_PAGE_SIZE':20,
+    'SEARCH_PAGE_SIZE':20,
+    'API_PAGE_SIZE':20,
+    'API_MAX_PAGE_SIZE':1000,
+    'ADMIN_PAGE_SIZE':50,
+    # Compress responses of COMPRESSION_TYPES of at least COMPRESSION_MIN_SIZE bytes for clients accepting it
+    'COMPRESSION':True,
+    'COMPRESSION_MIN_SIZE':500,
+    'COMPRESSION_GZIP_LEVEL':6,
+    'COMPRESSION_BROTLI_QUALITY':4,
+    'COMPRESSION_TYPES':('text/html','text/css','text/csv','text/plain','application/json','application/javascript',
+        'image/svg+xml'),
+    'LOG_LEVEL':'INFO',
+    # Levels of single loggers by name, like {'blog.auth':'DEBUG','sqlalchemy.engine':'INFO'}
+    'LOG_LEVELS':{},
+    # Log records waiting for the log thread past this many are dropped rather than block requests
+    'LOG_QUEUE_SIZE':10000,
+    # Where 'flask assets build' writes fingerprinted assets, None builds them into static/build
+    'ASSET_BUILD_DIR':None,
+    'FEED_CACHE_SIZE':128,
+    'FEED_CACHE_TTL':30,
+    'BCRYPT_ROUNDS':12,
+    'TOKEN_LIFETIME_HOURS':3,
+    # Share revoked tokens between processes through the revoked_tokens table
+    'REVOCATION_SHARED':False,
+    'REVOCATION_SYNC_INTERVAL':5,
+    'HASH_WORKERS':os.cpu_count() or 1,
+    # None queues up to twice HASH_WORKERS jobs
+    'HASH_QUEUE_LIMIT':None,
+    # Token buckets in front of login and register, one per client IP and one per account e-mail
+    'RATE_LIMIT':True,
+    'RATE_LIMIT_IP_PER_MINUTE':10,
+    'RATE_LIMIT_IP_BURST':20,
+    'RATE_LIMIT_ACCOUNT_PER_MINUTE':2,
+    'RATE_LIMIT_ACCOUNT_BURST':5,
+    # Buckets kept in memory, the least recently used are dropped past this many
+    'RATE_LIMIT_MAX_KEYS':100000,
+    # Share the buckets between processes through the rate_limits table
+    'RATE_LIMIT_SHARED':False,
+    # Proxies in front of the app, the client IP is read from the X-Forwarded-For entry they added
+    'TRUSTED_PROXIES':0,
+    'DB_POOL_SIZE':5,
+    'DB_MAX_OVERFLOW':10,
+    'DB_POOL_TIMEOUT':30,
+    'DB_POOL_RECYCLE':1800,
+    'DB_POOL_PRE_PING':False,
+    'DB_CONNECT_TIMEOUT':5,
+    # Milliseconds, 0 leaves statements without a timeout
+    'DB_STATEMENT_TIMEOUT':0,
+    # Read replicas, the reads of GET requests are spread over them round robin
+    'SQLALCHEMY_REPLICA_URIS':[],
+    # Seconds between health checks of each replica, and the replication lag past which a replica is skipped
+    'REPLICA_CHECK_INTERVAL':5,
+    'REPLICA_MAX_LAG':10,
+    # Seconds the reads of a session stay on the primary after it wrote, so users see their own changes. They skip
+    # the feed cache for as long, or for FEED_CACHE_TTL seconds when that is longer
+    'REPLICA_READ_YOUR_WRITES':10,
+}
+
+def env_flag(value):
+    '''
+    Read a boolean environment variable
+    '''
+    return value.strip().lower() in ('1','true','yes','on')
+
+def env_list(value):
+    '''
+    Read a comma separated environment variable
+    '''
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+def env_levels(value):
+    '''
+    Read a comma separated environment variable of logger=LEVEL pairs
+    '''
+    return {name.strip():level.strip().upper() for name,level in (item.split('=',1) for item in env_list(value))}
+
+# Environment variables read by config_from_env with the config key each one sets and how to parse it
+ENV_CONFIG = {
+    'SECRET_KEY':('SECRET_KEY',str),
+    'SECRET_KEY_FALLBACKS':('SECRET_KEY_FALLBACKS',env_list),
+    'DATABASE_URL':('SQLALCHEMY_DATABASE_URI',str),
+    'BCRYPT_ROUNDS':('BCRYPT_ROUNDS',int),
+    'TOKEN_LIFETIME_HOURS':('TOKEN_LIFETIME_HOURS',int),
+    'REVOCATION_SHARED':('REVOCATION_SHARED',env_flag),
+    'REVOCATION_SYNC_INTERVAL':('REVOCATION_SYNC_INTERVAL',int),
+    'HASH_WORKERS':('HASH_WORKERS',int),
+    'HASH_QUEUE_LIMIT':('HASH_QUEUE_LIMIT',int),
+    'RATE_LIMIT':('RATE_LIMIT',env_flag),
+    'RATE_LIMIT_IP_PER_MINUTE':('RATE_LIMIT_IP_PER_MINUTE',float),
+    'RATE_LIMIT_IP_BURST':('RATE_LIMIT_IP_BURST',int),
+    'RATE_LIMIT_ACCOUNT_PER_MINUTE':('RATE_LIMIT_ACCOUNT_PER_MINUTE',float),
+    'RATE_LIMIT_ACCOUNT_BURST':('RATE_LIMIT_ACCOUNT_BURST',int),
+    'RATE_LIMIT_MAX_KEYS':('RATE_LIMIT_MAX_KEYS',int),
+    'RATE_LIMIT_SHARED':('RATE_LIMIT_SHARED',env_flag),
+    'TRUSTED_PROXIES':('TRUSTED_PROXIES',int),
+    'COMPRESSION':('COMPRESSION',env_flag),
+    'COMPRESSION_MIN_SIZE':('COMPRESSION_MIN_SIZE',int),
+    'COMPRESSION_GZIP_LEVEL':('COMPRESSION_GZIP_LEVEL',int),
+    'COMPRESSION_BROTLI_QUALITY':('COMPRESSION_BROTLI_QUALITY',int),
+    'LOG_LEVEL':('LOG_LEVEL',str.upper),
+    'LOG_LEVELS':('LOG_LEVELS',env_levels),
+    'LOG_QUEUE_SIZE':('LOG_QUEUE_SIZE',int),
+    'DB_POOL_SIZE':('DB_POOL_SIZE',int),
+    'DB_MAX_OVERFLOW':('DB_MAX_OVERFLOW',int),
+    'DB_POOL_TIMEOUT':('DB_POOL_TIMEOUT',int),
+    'DB_POOL_RECYCLE':('DB_POOL_RECYCLE',int),
+    'DB_POOL_PRE_PING':('DB_POOL_PRE_PING',env_flag),
+    'DB_CONNECT_TIMEOUT':('DB_CONNECT_TIMEOUT',int),
+    'DB_STATEMENT_TIMEOUT':('DB_STATEMENT_TIMEOUT',int),
+    'DATABASE_REPLICA_URLS':('SQLALCHEMY_REPLICA_URIS',env_list),
+    'REPLICA_CHECK_INTERVAL':('REPLICA_CHECK_INTERVAL',float),
+    'REPLICA_MAX_LAG':('REPLICA_MAX_LAG',float),
+    'REPLICA_READ_YOUR_WRITES':('REPLICA_READ_YOUR_WRITES',float),
+}
+
+def config_from_env():
+    '''
+    Config read from the environment. Only the variables that are set are returned so DEFAULT_CONFIG fills the rest
+    '''
+    return {key:parse(os.environ[name]) for name,(key,parse) in ENV_CONFIG.items() if name in os.environ}
+
+# LOGGING
+log = logging.getLogger('blog')
+auth_log = logging.getLogger('blog.auth')
+feed_log = logging.getLogger('blog.feed')
+posts_log = logging.getLogger('blog.posts')
+api_log = logging.getLogger('blog.api')
+health_log = logging.getLogger('blog.health')
+
+# Attributes every log record has, anything else on a record was passed as extra and is logged as a field
+RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | {'message','asctime'}
+# Request ids accepted from the X-Request-Id header, anything else is replaced by a fresh id
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Format log records as single line JSON objects with the time, level, logger and message along with the
+    request fields and any extra fields of the record
+    '''
+    def format(self,record):
+        entry = {
+            'time':datetime.fromtimestamp(record.created,timezone.utc).isoformat(timespec='milliseconds'),
+            'level':record.levelname,
+            'logger':record.name,
+            'message':record.getMessage(),
+        }
+        entry.update((key,value) for key,value in record.__dict__.items() if key not in RECORD_ATTRIBUTES)
+        return json.dumps(entry,default=str)
+
+class RequestQueueHandler(QueueHandler):
+    '''
+    Queue handler that tags records with the id, method and path of the request logging them, while still on the
+    request thread. A full queue drops the record and counts it instead of blocking the request
+    '''
+    def __init__(self,log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self,record):
+        record = super().prepare(record)
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.method = request.method
+            record.path = request.path
+        return record
+
+    def enqueue(self,record):
+        try:
+            self.queue.put_nowait(record)
+        except(queue.Full):
+            self.dropped += 1
+
+def configure_logging(config):
+    '''
+    Route every log record through a bounded queue drained by a background thread that writes them to stdout as
+    JSON lines, so a slow log sink never holds up a request. The handler is installed once per process, later
+    calls only apply LOG_LEVEL to the root logger and LOG_LEVELS to single loggers
+    '''
+    root = logging.getLogger()
+    if not any(isinstance(handler,RequestQueueHandler) for handler in root.handlers):
+        log_queue = queue.Queue(config['LOG_QUEUE_SIZE'])
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(JsonFormatter())
+        listener = QueueListener(log_queue,stream)
+        listener.start()
+        # Write out whatever is still queued when the process exits
+        atexit.register(listener.stop)
+        root.addHandler(RequestQueueHandler(log_queue))
+    root.setLevel(config['LOG_LEVEL'])
+    for name,level in config['LOG_LEVELS'].items():
+        logging.getLogger(name).setLevel(level)
+
+def dropped_log_records():
+    '''
+    Log records dropped because the log queue was full
+    '''
+    return sum(handler.dropped for handler in logging.getLogger().handlers
+        if isinstance(handler,RequestQueueHandler))
+
+def assign_request_id():
+    '''
+    Give the request an id, the one from the X-Request-Id header of the proxy when it is well formed
+    '''
+    request_id = request.headers.get('X-Request-Id','')
+    g.request_id = request_id if REQUEST_ID_PATTERN.fullmatch(request_id) else secrets.token_hex(8)
+
+def send_request_id(response):
+    '''
+    Echo the request id in the response so clients can quote it
+    '''
+    response.headers['X-Request-Id'] = g.request_id
+    return response
 
 #FLASK_SQLALCHEMY ORM SETUP
+class RoutingSession(SignallingSession):
+    '''
+    Session sending the reads of read-only requests to a read replica and everything else to the primary.
+    Flushes, INSERT, UPDATE, DELETE and SELECT ... FOR UPDATE always run on the primary, and once a request has
+    written its later reads stay there too. A read the replica fails to answer is run again on the primary
+    '''
+    def execute(self,statement,*args,**kwargs):
+        '''
+        Run statement, once more on the primary when it was a read the replica of the request failed to answer
+        '''
+        try:
+            return super().execute(statement,*args,**kwargs)
+        except(sqlalchemy_exceptions.OperationalError,sqlalchemy_exceptions.DisconnectionError) as error:
+            # Writes and the reads after them leave db_replica unset, so only reads that went to a replica are retried
+            replica = g.get('db_replica') if has_request_context() else None
+            if replica is None:
+                raise
+            log.warning('Read replica %s failed, reading from the primary',replica.url.host,extra={'error':str(error)})
+            current_app.extensions['replicas'].mark_down(replica)
+            self.rollback()
+            use_primary()
+            return super().execute(statement,*args,**kwargs)
+
+    def get_bind(self,mapper=None,clause=None,**kwargs):
+        primary = super().get_bind(mapper,clause)
+        if self._flushing or getattr(clause,'is_dml',False) or getattr(clause,'_for_update_arg',None) is not None:
+            record_write()
+            return primary
+        replica = read_replica()
+        return replica if replica is not None else primary
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    '''
+    SQLAlchemy extension whose sessions are RoutingSessions
+    '''
+    def create_session(self,options):
+        return orm.sessionmaker(class_=RoutingSession,db=self,**options)
+
+# Bound to each application by create_app. Nothing connects to the database until a request or command needs it
+db = RoutingSQLAlchemy()
+
+class TimedQueuePool(QueuePool):
+    '''
+    QueuePool that counts checkouts and adds up how long they waited for a free connection, so pool_stats can tell
+    requests queueing on connections apart from requests queueing on CPU
+    '''
+    def __init__(self,*args,**kwargs):
+        super().__init__(*args,**kwargs)
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.wait_seconds = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except(sqlalchemy_exceptions.TimeoutError):
+            self.checkout_timeouts += 1
+            raise
+        finally:
+            self.checkouts += 1
+            self.wait_seconds += time.perf_counter() - start
+
+def engine_options(config):
+    '''
+    SQLAlchemy engine options for the DB_* pool settings in config.
+    Postgres connections also get the connect timeout and the statement timeout
+    '''
+    options = {
+        'poolclass':TimedQueuePool,
+        'pool_size':config['DB_POOL_SIZE'],
+        'max_overflow':config['DB_MAX_OVERFLOW'],
+        'pool_timeout':config['DB_POOL_TIMEOUT'],
+        'pool_recycle':config['DB_POOL_RECYCLE'],
+        'pool_pre_ping':config['DB_POOL_PRE_PING'],
+    }
+    if config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+        connect_args = {'connect_timeout':config['DB_CONNECT_TIMEOUT']}
+        if config['DB_STATEMENT_TIMEOUT']:
+            connect_args['options'] = f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT']}"
+        options['connect_args'] = connect_args
+    return options
+
+def pool_stats():
+    '''
+    Statistics of the connection pool of the current application's engine
+    '''
+    pool = db.engine.pool
+    return {
+        'size':pool.size(),
+        'checked_out':pool.checkedout(),
+        'checked_in':pool.checkedin(),
+        # QueuePool counts overflow from -size, it only goes above 0 once connections past the pool size are open
+        'overflow':max(pool.overflow(),0),
+        'checkouts':pool.checkouts,
+        'checkout_timeouts':pool.checkout_timeouts,
+        'wait_seconds_total':round(pool.wait_seconds,6),
+    }
+
+# READ REPLICAS
+# Seconds a Postgres replica lags the primary, 0 when it has replayed everything it received or is no replica
+REPLICA_LAG_SQL = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+'''
+
+class ReplicaSet:
+    '''
+    The read replica engines of an application, handed out round robin.
+    Once start() is called a background thread checks every replica each check_interval seconds: it has to answer
+    and, on Postgres, lag the primary by at most max_lag seconds. Requests only read the outcome of the last check,
+    so a slow or unreachable replica never holds one up. A replica whose statement fails is marked down until its
+    next check. pick() returns None when no replica is healthy, so reads fall back to the primary
+    '''
+    def __init__(self,engines,check_interval,max_lag):
+        self.engines = engines
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self._healthy = [False] * len(engines)
+        self._turns = cycle(range(len(engines)))
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self.engines)
+
+    def healthy(self):
+        '''
+        Number of replicas that passed their last check
+        '''
+        return sum(self._healthy)
+
+    def pick(self):
+        '''
+        The next healthy replica engine in turn, None when there is none
+        '''
+        start = next(self._turns)
+        for offset in range(len(self.engines)):
+            index = (start + offset) % len(self.engines)
+            if self._healthy[index]:
+                return self.engines[index]
+        return None
+
+    def start(self):
+        '''
+        Start the thread checking the replicas, its first round runs straight away. Stopped when the process exits
+        '''
+        if self.engines and self._thread is None:
+            self._thread = threading.Thread(target=self.run_checks,name='replica-checks',daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        '''
+        Stop the checking thread once its current round is over
+        '''
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run_checks(self):
+        '''
+        Body of the checking thread, checks every replica each check_interval seconds until stop() is called
+        '''
+        while not self._stopped.is_set():
+            self.check_all()
+            self._stopped.wait(self.check_interval)
+
+    def check_all(self):
+        '''
+        Check every replica once and record which are healthy
+        '''
+        for index in range(len(self.engines)):
+            self._healthy[index] = self.check(index)
+
+    def check(self,index):
+        '''
+        True when replica index answers and does not lag too far behind
+        '''
+        engine = self.engines[index]
+        try:
+            with engine.connect() as connection:
+                if engine.dialect.name != 'postgresql':
+                    connection.execute(text('SELECT 1'))
+                    return True
+                lag = connection.execute(text(REPLICA_LAG_SQL)).scalar()
+        except(sqlalchemy_exceptions.DBAPIError) as error:
+            log.warning('Read replica %s failed its health check',engine.url.host,extra={'error':str(error)})
+            return False
+        if lag > self.max_lag:
+            log.warning('Read replica %s lags %.1f seconds behind the primary',engine.url.host,lag)
+            return False
+        return True
+
+    def mark_down(self,engine):
+        '''
+        Skip the replica engine until its next check, after one of its statements failed
+        '''
+        self._healthy[self.engines.index(engine)] = False
+
+def replica_set(config):
+    '''
+    The ReplicaSet of the SQLALCHEMY_REPLICA_URIS in config, pooled like the primary. Nothing connects to a
+    replica until the ReplicaSet is started
+    '''
+    engines = [create_engine(uri,**engine_options({**config,'SQLALCHEMY_DATABASE_URI':uri}))
+        for uri in config['SQLALCHEMY_REPLICA_URIS']]
+    return ReplicaSet(engines,config['REPLICA_CHECK_INTERVAL'],config['REPLICA_MAX_LAG'])
+
+def read_replica():
+    '''
+    The replica engine the reads of the current request go to, None for the primary. Only GET, HEAD and OPTIONS
+    requests read from a replica, unless the request called use_primary() or its session is reading its
+    own writes. The replica is picked once per request, so every read of a request sees
+    the same snapshot of the data
+    '''
+    if not has_request_context():
+        return None
+    if 'db_replica' not in g:
+        replicas = current_app.extensions['replicas']
+        if not replicas or request.method not in ('GET','HEAD','OPTIONS') or reading_own_writes():
+            g.db_replica = None
+        else:
+            g.db_replica = replicas.pick()
+    return g.db_replica
+
+def reading_own_writes():
+    '''
+    True while the session of the current request wrote less than REPLICA_READ_YOUR_WRITES or FEED_CACHE_TTL seconds
+    ago, whichever is longer. Its reads then go to the primary and skip the feed cache, which other workers may
+    still hold from before the write
+    '''
+    return has_request_context() and session.get('read_primary_until',0) > time.time()
+
+def use_primary():
+    '''
+    Read from the primary for the rest of the current request
+    '''
+    g.db_replica = None
+
+def record_write():
+    '''
+    Note that the current request wrote, its later reads and those of its session for a while go to the primary
+    '''
+    if has_request_context():
+        g.db_replica = None
+        g.db_wrote = True
+
+def remember_writes(response):
+    '''
+    After a request that wrote, keep the reads of its session on the primary and off the feed cache until the
+    replicas and the caches of the other workers have caught up
+    '''
+    if g.get('db_wrote'):
+        config = current_app.config
+        session['read_primary_until'] = time.time() + max(config['REPLICA_READ_YOUR_WRITES'],config['FEED_CACHE_TTL'])
+    return response
+# METRICS
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10)
+# Upper bounds of the buckets counting SQL statements per request
+STATEMENT_BUCKETS = (0,1,2,3,5,10,20,50,100)
+
+def format_labels(names,values):
+    '''
+    Prometheus label set {name="value",...} with quotes, backslashes and newlines escaped, empty without labels
+    '''
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name,value in zip(names,escaped)) + '}'
+
+class Histogram:
+    '''
+    Prometheus histogram of observations for each combination of label values.
+    Each series keeps a count per bucket along with the sum and the count of its observations. The buckets are
+    made cumulative when the histogram is exposed
+    '''
+    def __init__(self,name,description,labels=(),buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self,value,*label_values):
+        '''
+        Count value in the series of label_values
+        '''
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1),0.0,0]
+            series[0][bisect.bisect_left(self.buckets,value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        '''
+        Lines of the histogram in the Prometheus text format
+        '''
+        lines = [f'# HELP {self.name} {self.description}',f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((label_values,list(counts),total,count)
+                for label_values,(counts,total,count) in self._series.items())
+        for label_values,counts,total,count in series:
+            cumulative = 0
+            for bound,bucket in zip((*self.buckets,math.inf),counts):
+                cumulative += bucket
+                upper = '+Inf' if bound == math.inf else repr(float(bound))
+                labels = format_labels((*self.labels,'le'),(*label_values,upper))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels,label_values)} {total!r}')
+            lines.append(f'{self.name}_count{format_labels(self.labels,label_values)} {count}')
+        return lines
+
+def expose_value(name,kind,description,value):
+    '''
+    Lines of a single counter or gauge in the Prometheus text format
+    '''
+    return [f'# HELP {name} {description}',f'# TYPE {name} {kind}',f'{name} {value!r}']
+
+class Metrics:
+    '''
+    The request metrics of an application.
+    Each request adds up the number and time of its SQL statements, its template render time and its password
+    hashing time on flask.g, and they are observed per route once the request is done. Statements, templates and
+    hashing are also observed one by one
+    '''
+    def __init__(self):
+        self.request_seconds = Histogram('http_request_duration_seconds',
+            'Time taken to answer requests, streamed bodies included.',('method','route','status'))
+        self.request_db_statements = Histogram('http_request_db_statements',
+            'SQL statements run per request.',('route',),STATEMENT_BUCKETS)
+        self.request_db_seconds = Histogram('http_request_db_seconds',
+            'Time spent running SQL statements per request.',('route',))
+        self.request_template_seconds = Histogram('http_request_template_seconds',
+            'Time spent rendering templates per request.',('route',))
+        self.request_hash_seconds = Histogram('http_request_password_hash_seconds',
+            'Time spent waiting on password hashing per request.',('route',))
+        self.db_statement_seconds = Histogram('db_statement_duration_seconds','Time taken by SQL statements.')
+        self.template_seconds = Histogram('template_render_duration_seconds','Time taken to render templates.',
+            ('template',))
+        self.hash_seconds = Histogram('password_hash_duration_seconds',
+            'Time taken to hash or check passwords, queueing on the hashing pool included.',('operation',))
+
+    def expose(self,app):
+        '''
+        Every metric of app in the Prometheus text format, the histograms followed by the feed cache, token
+        denylist, rate limiter and connection pool statistics
+        '''
+        lines = []
+        for histogram in (self.request_seconds,self.request_db_statements,self.request_db_seconds,
+                self.request_template_seconds,self.request_hash_seconds,self.db_statement_seconds,
+                self.template_seconds,self.hash_seconds):
+            lines.extend(histogram.expose())
+        feed_cache = app.extensions['feed_cache'].stats()
+        lines.extend(expose_value('feed_cache_hits_total','counter','Feed cache lookups that hit.',
+            feed_cache['hits']))
+        lines.extend(expose_value('feed_cache_misses_total','counter','Feed cache lookups that missed.',
+            feed_cache['misses']))
+        lines.extend(expose_value('feed_cache_entries','gauge','Pages held by the feed cache.',
+            feed_cache['entries']))
+        lines.extend(expose_value('revoked_tokens','gauge','Revoked tokens held by the token denylist.',
+            len(app.extensions['token_denylist'])))
+        lines.extend(expose_value('db_replicas_healthy','gauge','Read replicas that passed their last health check.',
+            app.extensions['replicas'].healthy()))
+        lines.extend(expose_value('rate_limited_total','counter','Logins and registrations turned away with 429.',
+            app.extensions['rate_limiter'].rejected))
+        lines.extend(expose_value('rate_limit_buckets','gauge','Token buckets held in memory.',
+            len(app.extensions['rate_limiter'])))
+        lines.extend(expose_value('log_records_dropped_total','counter',
+            'Log records dropped because the log queue was full.',dropped_log_records()))
+        pool = pool_stats()
+        lines.extend(expose_value('db_pool_size','gauge','Connections the pool keeps open.',pool['size']))
+        lines.extend(expose_value('db_pool_checked_out','gauge','Connections in use.',pool['checked_out']))
+        lines.extend(expose_value('db_pool_overflow','gauge','Connections open past the pool size.',
+            pool['overflow']))
+        lines.extend(expose_value('db_pool_checkouts_total','counter','Connections handed out by the pool.',
+            pool['checkouts']))
+        lines.extend(expose_value('db_pool_checkout_timeouts_total','counter',
+            'Checkouts that gave up waiting for a connection.',pool['checkout_timeouts']))
+        lines.extend(expose_value('db_pool_wait_seconds_total','counter',
+            'Time spent waiting for a free connection.',pool['wait_seconds_total']))
+        return '\n'.join(lines) + '\n'
+
+def request_route():
+    '''
+    The route pattern of the current request, so every post id shares one series, or 'unmatched'
+    '''
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+def add_request_time(key,seconds):
+    '''
+    Add seconds to the key total of the current request, if there is one
+    '''
+    if has_request_context() and 'request_timings' in g:
+        g.request_timings[key] += seconds
+
+def start_request_metrics():
+    '''
+    Start timing the request and its SQL statements, templates and password hashing
+    '''
+    g.request_timings = {'start':time.perf_counter(),'db_statements':0,'db_seconds':0.0,'template_seconds':0.0,
+        'hash_seconds':0.0}
+
+def record_response_status(response):
+    '''
+    Keep the status of the response until the request is done, streamed responses finish after this
+    '''
+    g.response_status = response.status_code
+    return response
+
+def observe_request_metrics(error=None):
+    '''
+    Observe the metrics of the request once it is done, after any streamed body has been sent
+    '''
+    timings = g.pop('request_timings',None)
+    if timings is None:
+        return
+    metrics = current_app.extensions['metrics']
+    route = request_route()
+    status = g.pop('response_status',500 if error is not None else 200)
+    metrics.request_seconds.observe(time.perf_counter() - timings['start'],request.method,route,str(status))
+    metrics.request_db_statements.observe(timings['db_statements'],route)
+    metrics.request_db_seconds.observe(timings['db_seconds'],route)
+    metrics.request_template_seconds.observe(timings['template_seconds'],route)
+    metrics.request_hash_seconds.observe(timings['hash_seconds'],route)
+
+@event.listens_for(Engine,'before_cursor_execute')
+def start_statement_timer(_conn,_cursor,_statement,_parameters,context,_executemany):
+    '''
+    Note when each SQL statement starts, on its execution context. A statement that fails never reaches
+    stop_statement_timer, and its start goes away with the context
+    '''
+    if context is not None:
+        context.statement_start = time.perf_counter()
+
+@event.listens_for(Engine,'after_cursor_execute')
+def stop_statement_timer(_conn,_cursor,_statement,_parameters,context,_executemany):
+    '''
+    Observe how long each SQL statement took and add it to the statements of the current request
+    '''
+    start = getattr(context,'statement_start',None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    if not has_app_context() or 'metrics' not in current_app.extensions:
+        return
+    current_app.extensions['metrics'].db_statement_seconds.observe(elapsed)
+    if has_request_context() and 'request_timings' in g:
+        g.request_timings['db_statements'] += 1
+        g.request_timings['db_seconds'] += elapsed
+
+class TimedTemplate(Template):
+    '''
+    Jinja template that observes how long each render takes
+    '''
+    def render(self,*args,**kwargs):
+        start = time.perf_counter()
+        try:
+            return super().render(*args,**kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            if has_app_context() and 'metrics' in current_app.extensions:
+                current_app.extensions['metrics'].template_seconds.observe(elapsed,self.name or 'string')
+                add_request_time('template_seconds',elapsed)
 
-db = SQLAlchemy(app)
-retries = 5
-while (retries !=0):
-    try:
-        db.create_all()
-        break
-    except(Exception) as e:
-        retries -=1
-        print(f'Retries left : {retries}')
-        print(e)
-        time.sleep(5)
 # USER MODEL
 class User(db.Model):
     '''
@@ -41,6 +761,7 @@ class User(db.Model):
     Username as a string
     Password as a Binary
     admin_tatus as a Boolean
+    post_count as an integer
     A one to many reltation with the Posts model called posts
     '''
     __tablename__='users'
@@ -49,9 +770,14 @@ class User(db.Model):
     password=(db.Column)(db.LargeBinary,nullable=False)
     email = (db.Column)(db.String(40),unique=True,nullable=False)
     admin_status=(db.Column)(db.Boolean,nullable=True)
+    # Number of posts by the user, kept in step with every post created or deleted so author pages never count
+    post_count=(db.Column)(db.Integer,nullable=False,default=0,server_default='0')
     posts = (db.relationship('Post', backref='user', lazy=True))
     def __repr__(self):
         return f'<User Model with username {self.username}>'
+# Indexes serving prefix search on usernames and emails whatever the collation, created by migration 6
+db.Index('ix_users_username_prefix',User.username,postgresql_ops={'username':'varchar_pattern_ops'})
+db.Index('ix_users_email_prefix',User.email,postgresql_ops={'email':'varchar_pattern_ops'})
 # POST MODEL
 class Post(db.Model):
     '''
@@ -61,6 +787,7 @@ class Post(db.Model):
     Body as a string max-length 500 characters
     Timestamp as a Date
     user_id as a FK showing relation to the owner user
+    search_vector as the tsvector of the weighted title and body, generated by Postgres and only loaded on demand
     '''
     __tablename__='posts'
     id = db.Column(db.Integer, primary_key=True)
@@ -68,13 +795,969 @@ class Post(db.Model):
     body  = (db.Column)(db.String(500),nullable=False)
     user_id= (db.Column)(db.Integer, db.ForeignKey('users.id'))
     timestamp = (db.Column)(db.Date, nullable=False)
+    search_vector = db.deferred(db.Column(TSVECTOR, db.Computed(
+        "setweight(to_tsvector('english', title), 'A') || setweight(to_tsvector('english', body), 'B')",
+        persisted=True)))
     def __repr__(self):
         return f'<Post Model with id {self.id}>'
 
+# Indexes matching the feed order and the per owner access path, created by migration 2
+db.Index('ix_posts_timestamp_id',Post.timestamp.desc(),Post.id.desc())
+db.Index('ix_posts_user_id_timestamp',Post.user_id,Post.timestamp.desc(),Post.id.desc())
+# GIN index serving full text search, created by migration 4
+db.Index('ix_posts_search_vector',Post.search_vector,postgresql_using='gin')
+
+# REVOKED TOKEN MODEL
+class RevokedToken(db.Model):
+    '''
+    Model for the revoked_tokens table, the store of revoked tokens shared by every process
+    jti PK as the id of the revoked token
+    expires_at as the UTC expiry of the token, the row is useless after it
+    revoked_at as the database time of the revocation, used to pull revocations made since the last sync
+    '''
+    __tablename__='revoked_tokens'
+    jti = db.Column(db.String(32), primary_key=True)
+    expires_at = (db.Column)(db.DateTime, nullable=False, index=True)
+    revoked_at = (db.Column)(db.DateTime, nullable=False, server_default=db.func.now(), index=True)
+    def __repr__(self):
+        return f'<RevokedToken Model with jti {self.jti}>'
+
+# RATE LIMIT MODEL
+class RateLimit(db.Model):
+    '''
+    Model for the rate_limits table, the token buckets shared by every process
+    bucket PK as the key of the bucket, like 'ip:203.0.113.7'
+    full_at as the unix time the bucket is full again, the row is useless after it
+    '''
+    __tablename__='rate_limits'
+    bucket = db.Column(db.String(255), primary_key=True)
+    full_at = (db.Column)(db.Float, nullable=False, index=True)
+    def __repr__(self):
+        return f'<RateLimit Model with bucket {self.bucket}>'
+
+# FEED VERSION MODEL
+class FeedVersion(db.Model):
+    '''
+    Model for the feed_version table, a single row counting the changes made to posts
+    id PK, always 1
+    version as the number of times posts were created, updated or deleted, bumped in the same transaction
+    changed_at as the UTC time of the latest change, None until the first one
+    '''
+    __tablename__='feed_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = (db.Column)(db.BigInteger, nullable=False)
+    changed_at = (db.Column)(db.DateTime, nullable=True)
+    def __repr__(self):
+        return f'<FeedVersion Model with version {self.version}>'
+
+@event.listens_for(FeedVersion.__table__,'after_create')
+def insert_feed_version(target,connection,**kwargs):
+    '''
+    Insert the only row when db.create_all() makes the table, migration 5 does the same
+    '''
+    connection.execute(target.insert().values(id=1,version=0))
+
+# FEED PAGINATION
+def encode_cursor(post):
+    '''
+    Encode the (timestamp, id) sort key of a post into the cursor string used by the older/newer feed links
+    '''
+    return f'{post.timestamp.isoformat()}_{post.id}'
+
+def decode_cursor(cursor):
+    '''
+    Decode a cursor made by encode_cursor back into a (timestamp, id) tuple.
+    Malformed cursors raise a BadRequest
+    '''
+    try:
+        timestamp,post_id = cursor.split('_')
+        return date.fromisoformat(timestamp),int(post_id)
+    except(ValueError) as error:
+        raise werkzeug_exceptions.BadRequest from error
+
+# Columns a feed row can be made of, by field name
+POST_FIELDS = {
+    'id':Post.id,
+    'title':Post.title,
+    'body':Post.body,
+    'timestamp':Post.timestamp,
+    'user_id':Post.user_id,
+    'username':User.username,
+}
+FEED_FIELDS = ('id','title','body','timestamp','username')
+
+def posts_query(fields):
+    '''
+    Query selecting only the POST_FIELDS named by fields, labelled with their names.
+    Posts are outer joined to their author only when the username is asked for
+    '''
+    query = db.session.query(*(POST_FIELDS[name].label(name) for name in fields)).select_from(Post)
+    if 'username' in fields:
+        query = query.outerjoin(User,Post.user_id == User.id)
+    return query
+
+def feed_query(before,after,page_size,fields=FEED_FIELDS,user_id=None):
+    '''
+    Query for page_size + 1 feed rows of the POST_FIELDS named by fields on either side of a cursor, by default
+    (id, title, body, timestamp, username). The id and timestamp sort key is selected along with the fields.
+    Posts are joined to their author in the same query, so rendering the page never lazy loads a user.
+    Passing user_id keeps only the posts of that user, read through the index on (user_id, timestamp, id).
+    Rows come back in index order, newest first when walking backwards from before (or from the top of the feed)
+    and oldest first when walking forwards from after
+    '''
+    sort_key = tuple_(Post.timestamp,Post.id)
+    query = posts_query([*fields,*(name for name in ('id','timestamp') if name not in fields)])
+    if user_id is not None:
+        query = query.filter(Post.user_id == user_id)
+    if after is not None:
+        query = query.filter(sort_key > tuple_(*decode_cursor(after))).order_by(Post.timestamp,Post.id)
+    else:
+        if before is not None:
+            query = query.filter(sort_key < tuple_(*decode_cursor(before)))
+        query = query.order_by(Post.timestamp.desc(),Post.id.desc())
+    return query.limit(page_size + 1)
+
+def query_feed_page(before=None,after=None,page_size=None,user_id=None):
+    '''
+    Keyset pagination over the posts feed, newest first, ordered by (timestamp, id).
+    Passing the before cursor returns the page of posts older than it, passing the after cursor returns the page
+    of posts newer than it. Only page_size + 1 rows are ever read so the work per page is bounded.
+    Passing user_id pages through the posts of that user only.
+    Returns the posts of the page and the cursors of the older and newer pages (None when there is no such page)
+    '''
+    page_size = page_size or current_app.config['FEED_PAGE_SIZE']
+    posts = feed_query(before,after,page_size,user_id=user_id).all()
+    has_more = len(posts) > page_size
+    posts = posts[:page_size]
+    if after is not None:
+        # Walked forwards from the cursor, flip the page back to newest first
+        posts.reverse()
+        has_older,has_newer = True,has_more
+    else:
+        has_older,has_newer = has_more,before is not None
+    older = encode_cursor(posts[-1]) if posts and has_older else None
+    newer = encode_cursor(posts[0]) if posts and has_newer else None
+    return posts,older,newer
+
+# SEARCH
+def search_query(terms,after,page_size):
+    '''
+    Query for page_size + 1 posts matching the search terms as rows of (id, title, body, timestamp, username, rank),
+    best ranked first. Terms use the web search syntax, "quoted phrases", or and -excluded words.
+    Matches are found through the GIN index on search_vector. The after cursor holds the (rank, id) of the last
+    result of the previous page. The rank is read as a double so the cursor round trips exactly
+    '''
+    tsquery = func.websearch_to_tsquery('english',terms)
+    rank = cast(func.ts_rank(Post.search_vector,tsquery),DOUBLE_PRECISION)
+    query = (db.session.query(Post.id,Post.title,Post.body,Post.timestamp,User.username,rank.label('rank'))
+        .outerjoin(User,Post.user_id == User.id)
+        .filter(Post.search_vector.op('@@')(tsquery)))
+    if after is not None:
+        query = query.filter(tuple_(rank,Post.id) < tuple_(*decode_search_cursor(after)))
+    return query.order_by(rank.desc(),Post.id.desc()).limit(page_size + 1)
+
+def decode_search_cursor(cursor):
+    '''
+    Decode a search cursor of the form <rank>_<id> into a (rank, id) tuple.
+    Malformed cursors raise a BadRequest
+    '''
+    try:
+        rank,post_id = cursor.split('_')
+        return float(rank),int(post_id)
+    except(ValueError) as error:
+        raise werkzeug_exceptions.BadRequest from error
+
+def query_search_page(terms,after=None):
+    '''
+    One page of search results and the cursor of the next page (None when there are no more results)
+    '''
+    page_size = current_app.config['SEARCH_PAGE_SIZE']
+    results = search_query(terms,after,page_size).all()
+    more = None
+    if len(results) > page_size:
+        results = results[:page_size]
+        more = f'{results[-1].rank!r}_{results[-1].id}'
+    return results,more
+
+# USER DIRECTORY
+def prefix_pattern(prefix):
+    '''
+    LIKE pattern matching every string starting with prefix, with the wildcards of prefix escaped by backslashes
+    '''
+    return prefix.replace('\\','\\\\').replace('%','\\%').replace('_','\\_') + '%'
+
+def user_directory_query(prefix,after,*columns):
+    '''
+    Query for the columns of users whose username or email starts with prefix (every user when it is empty),
+    ordered by username. The after cursor holds the last username of the previous page.
+    Prefixes are matched through the varchar_pattern_ops indexes, the order and the cursor through the unique
+    index on username
+    '''
+    query = db.session.query(*columns)
+    if prefix:
+        pattern = prefix_pattern(prefix)
+        query = query.filter(or_(User.username.like(pattern,escape='\\'),User.email.like(pattern,escape='\\')))
+    if after is not None:
+        query = query.filter(User.username > after)
+    return query.order_by(User.username)
+
+def query_user_page(prefix,after=None):
+    '''
+    One page of (username, email, admin_status) users and the cursor of the next page (None on the last page)
+    '''
+    page_size = current_app.config['ADMIN_PAGE_SIZE']
+    users = (user_directory_query(prefix,after,User.username,User.email,User.admin_status)
+        .limit(page_size + 1).all())
+    more = None
+    if len(users) > page_size:
+        users = users[:page_size]
+        more = users[-1].username
+    return users,more
+
+def stream_users_csv(prefix):
+    '''
+    Stream every user whose username or email starts with prefix as CSV lines of username, email, admin_status.
+    Rows are fetched API_FETCH_SIZE at a time through a server side cursor and written out one line at a time
+    '''
+    line = io.StringIO()
+    writer = csv.writer(line)
+    def csv_line(*values):
+        line.seek(0)
+        line.truncate()
+        writer.writerow(values)
+        return line.getvalue()
+    yield csv_line('username','email','admin_status')
+    query = user_directory_query(prefix,None,User.username,User.email,User.admin_status)
+    for user in query.yield_per(API_FETCH_SIZE):
+        yield csv_line(user.username,user.email,user.admin_status is True)
+
+# FEED CACHE
+class FeedCache:
+    '''
+    In-process LRU cache of feed pages with a time to live in seconds, along with the feed version they were read at.
+    Entries are dropped once they expire or when the cache grows past max_entries, least recently used first.
+    invalidate() empties the cache and bumps the generation so pages built from a read that started before the
+    invalidation are never stored. hits and misses count lookups to check the cache is working.
+    '''
+    def __init__(self,max_entries,ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get(self,key):
+        '''
+        Return the live entry stored under key or None, counting the lookup as a hit or a miss
+        '''
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                self._entries.pop(key,None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self,key,value,generation):
+        '''
+        Store value under key unless the cache was invalidated since generation was read
+        '''
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl,value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_version(self):
+        '''
+        Return the feed version stored by put_version if it is still live, else None
+        '''
+        version = self._version
+        if version is None or version[0] <= time.monotonic():
+            return None
+        return version[1]
+
+    def put_version(self,version,generation):
+        '''
+        Store the feed version read from the database unless the cache was invalidated since generation was read
+        '''
+        with self._lock:
+            if generation == self.generation:
+                self._version = (time.monotonic() + self.ttl,version)
+
+    def invalidate(self):
+        '''
+        Drop every entry and the feed version. Called after a commit that changes posts
+        '''
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+            self.generation += 1
+
+    def stats(self):
+        '''
+        Hit and miss counters along with the number of live entries
+        '''
+        return {'hits':self.hits,'misses':self.misses,'entries':len(self._entries)}
+
+def feed_version():
+    '''
+    The (version, changed_at) of the feed, read through the feed cache so validating a page costs at most one
+    primary key lookup every FEED_CACHE_TTL seconds. Sessions reading their own writes always read it
+    '''
+    if reading_own_writes():
+        return tuple(db.session.query(FeedVersion.version,FeedVersion.changed_at).filter(FeedVersion.id == 1).one())
+    feed_cache = current_app.extensions['feed_cache']
+    version = feed_cache.get_version()
+    if version is None:
+        generation = feed_cache.generation
+        version = tuple(db.session.query(FeedVersion.version,FeedVersion.changed_at).filter(FeedVersion.id == 1).one())
+        feed_cache.put_version(version,generation)
+    return version
+
+def bump_feed_version():
+    '''
+    Count a change to posts. Called before committing the change so both land in the same transaction
+    '''
+    db.session.query(FeedVersion).filter(FeedVersion.id == 1).update(
+        {FeedVersion.version:FeedVersion.version + 1,FeedVersion.changed_at:datetime.utcnow()},
+        synchronize_session=False)
+
+def count_posts(user_id,change):
+    '''
+    Add change to the post count of a user. Called before committing the post created or deleted so both land in
+    the same transaction
+    '''
+    db.session.query(User).filter(User.id == user_id).update({User.post_count:User.post_count + change},
+        synchronize_session=False)
+
+def recount_posts():
+    '''
+    Set the post count of every user from the posts table, after posts were written without count_posts
+    '''
+    post_count = db.session.query(func.count(Post.id)).filter(Post.user_id == User.id).scalar_subquery()
+    db.session.query(User).update({User.post_count:post_count},synchronize_session=False)
+
+def cached_feed_page(before=None,after=None,version=None):
+    '''
+    Fetch a page of the feed through the feed cache. Pages are cached per feed version, so a page read at an
+    older version is never served once a newer one has been seen.
+    Returns the cache entry, a dict holding the page data under 'page' and the guest rendering of the page under
+    'guest_html' once a guest has viewed it. Sessions reading their own writes get a fresh page that is not stored
+    '''
+    if reading_own_writes():
+        posts,older,newer = query_feed_page(before,after)
+        return {'page':{'posts':posts,'older':older,'newer':newer},'guest_html':None}
+    feed_cache = current_app.extensions['feed_cache']
+    key = (version,before,after,current_app.config['FEED_PAGE_SIZE'])
+    entry = feed_cache.get(key)
+    if entry is None:
+        generation = feed_cache.generation
+        posts,older,newer = query_feed_page(before,after)
+        entry = {'page':{'posts':posts,'older':older,'newer':newer},'guest_html':None}
+        feed_cache.put(key,entry,generation)
+    return entry
+
+# CONDITIONAL REQUESTS
+# Cache-Control of pages any cache may store as long as it revalidates them, and of pages only the browser of the
+# logged in user may store
+PUBLIC_CACHE_CONTROL = 'public, no-cache'
+PRIVATE_CACHE_CONTROL = 'private, no-cache'
+# Seconds pages that only change with a deploy are fresh for
+STATIC_PAGE_MAX_AGE = 300
+
+def template_version(app):
+    '''
+    Short digest of every template of app and of the asset manifest they link through, part of the validators
+    of rendered pages so a deploy that changes a template or an asset changes them too
+    '''
+    digest = hashlib.sha1(json.dumps(app.extensions['asset_manifest'],sort_keys=True).encode('utf-8'))
+    for name in sorted(app.jinja_loader.list_templates()):
+        digest.update(name.encode('utf-8'))
+        digest.update(app.jinja_loader.get_source(app.jinja_env,name)[0].encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+def is_fresh(etag,last_modified=None):
+    '''
+    True when the validators sent with the request show the client already has the current response.
+    If-None-Match is checked against the weak etag, If-Modified-Since against last_modified (a naive UTC datetime)
+    only when no If-None-Match was sent
+    '''
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified.replace(microsecond=0,tzinfo=timezone.utc) <= request.if_modified_since
+    return False
+
+def with_validators(response,etag,last_modified=None,cache_control=PUBLIC_CACHE_CONTROL):
+    '''
+    Set the weak ETag, the Last-Modified and the Cache-Control headers of response
+    '''
+    response.set_etag(etag,weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def not_modified(etag,last_modified=None,cache_control=PUBLIC_CACHE_CONTROL):
+    '''
+    Empty 304 response carrying the same validators as the full response
+    '''
+    return with_validators(Response(status=304),etag,last_modified,cache_control)
+
+# STATIC ASSETS
+# Fingerprinted assets never change under a given name, so anyone may keep them for a year without revalidating
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Extensions of the assets worth precompressing, the others are compressed already
+COMPRESSIBLE_ASSETS = ('.css','.js','.svg','.json','.txt','.html','.map')
+# Precompressed variants of an asset by content coding, preferred first
+ASSET_ENCODINGS = (('br','.br'),('gzip','.gz'))
+
+def asset_build_dir(app):
+    '''
+    Directory the fingerprinted assets of app are built into and served from
+    '''
+    return app.config['ASSET_BUILD_DIR'] or os.path.join(app.static_folder,'build')
+
+def load_asset_manifest(app):
+    '''
+    Manifest written by build_assets, mapping static paths to their fingerprinted names. Empty until assets are
+    built, then asset_url falls back to the plain static files
+    '''
+    try:
+        with open(os.path.join(asset_build_dir(app),'manifest.json'),encoding='utf-8') as manifest:
+            return json.load(manifest)
+    except(FileNotFoundError):
+        return {}
+
+def build_assets(app):
+    '''
+    Copy every file under static/ into the build directory under a name carrying a digest of its content, along
+    with gzip and, when the brotli package is installed, brotli variants of compressible files that come out
+    smaller. Then write the manifest. Builds of earlier versions are left in place so pages rendered by workers
+    still running them keep working during a deploy. Returns the manifest
+    '''
+    build_dir = asset_build_dir(app)
+    manifest = {}
+    for root,dirs,files in os.walk(app.static_folder):
+        dirs[:] = [name for name in dirs if os.path.abspath(os.path.join(root,name)) != os.path.abspath(build_dir)]
+        for name in files:
+            source = os.path.join(root,name)
+            path = os.path.relpath(source,app.static_folder).replace(os.sep,'/')
+            with open(source,'rb') as asset_file:
+                content = asset_file.read()
+            stem,extension = os.path.splitext(path)
+            built = f'{stem}.{hashlib.sha256(content).hexdigest()[:12]}{extension}'
+            variants = {built:content}
+            if extension in COMPRESSIBLE_ASSETS:
+                variants[built + '.gz'] = gzip.compress(content,9,mtime=0)
+                if brotli is not None:
+                    variants[built + '.br'] = brotli.compress(content,quality=11)
+            for variant,variant_content in variants.items():
+                if variant == built or len(variant_content) < len(content):
+                    destination = os.path.join(build_dir,variant)
+                    os.makedirs(os.path.dirname(destination),exist_ok=True)
+                    with open(destination,'wb') as variant_file:
+                        variant_file.write(variant_content)
+            manifest[path] = built
+    # Swap the manifest in whole so a worker starting meanwhile never reads half of it
+    manifest_path = os.path.join(build_dir,'manifest.json')
+    with open(manifest_path + '.tmp','w',encoding='utf-8') as manifest_file:
+        json.dump(manifest,manifest_file,indent=2,sort_keys=True)
+    os.replace(manifest_path + '.tmp',manifest_path)
+    return manifest
+
+def asset_url(path):
+    '''
+    URL of the file at path under static/, the URL of its fingerprinted build once assets are built.
+    Available to templates as asset_url
+    '''
+    built = current_app.extensions['asset_manifest'].get(path)
+    if built is None:
+        return url_for('static',filename=path)
+    return url_for('blog.asset',filename=built)
+
+# RESPONSE COMPRESSION
+class CompressionMiddleware:
+    '''
+    WSGI middleware compressing response bodies with brotli (when the brotli package is installed) or gzip,
+    whichever the client prefers by Accept-Encoding.
+    Only bodies of the compressible types are compressed, and only once they reach min_size bytes. Streamed bodies
+    are held back until min_size bytes have come through, so small ones still go out as they are, then compressed
+    chunk by chunk as the application yields them. Responses that already carry a Content-Encoding, such as the
+    precompressed assets, partial responses and responses marked no-transform are passed through untouched.
+    '''
+    def __init__(self,wsgi_app,min_size,gzip_level,brotli_quality,types):
+        self.wsgi_app = wsgi_app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.types = frozenset(types)
+
+    def choose_encoding(self,environ):
+        '''
+        The content coding to compress with, the accepted one with the highest quality, or None
+        '''
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return None
+        accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING',''))
+        encodings = ('br','gzip') if brotli is not None else ('gzip',)
+        encoding = max(encodings,key=lambda encoding: accepted[encoding])
+        return encoding if accepted[encoding] > 0 else None
+
+    def compressible(self,status,headers):
+        '''
+        True for responses whose body may be compressed, whatever the client accepts
+        '''
+        code = int(status.split(' ',1)[0])
+        mimetype = headers.get('Content-Type','').split(';')[0].strip()
+        return (code >= 200 and code not in (204,206,304) and mimetype in self.types
+            and 'Content-Encoding' not in headers and 'Content-Range' not in headers
+            and 'no-transform' not in headers.get('Cache-Control',''))
+
+    def compressor(self,encoding):
+        '''
+        (compress, finish) functions of a new compressor for encoding
+        '''
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            return compressor.process,compressor.finish
+        compressor = zlib.compressobj(self.gzip_level,zlib.DEFLATED,zlib.MAX_WBITS | 16)
+        return compressor.compress,compressor.flush
+
+    def __call__(self,environ,start_response):
+        encoding = self.choose_encoding(environ)
+        response = {}
+        body = []
+
+        def capture_start_response(status,headers,exc_info=None):
+            headers = Headers(headers)
+            if not self.compressible(status,headers):
+                return start_response(status,headers.to_wsgi_list(),exc_info)
+            # The response depends on Accept-Encoding even when this client gets it uncompressed
+            if 'accept-encoding' not in headers.get('Vary','').lower():
+                headers['Vary'] = ', '.join(filter(None,(headers.get('Vary'),'Accept-Encoding')))
+            length = headers.get('Content-Length',type=int)
+            if encoding is None or (length is not None and length < self.min_size):
+                return start_response(status,headers.to_wsgi_list(),exc_info)
+            response.update(status=status,headers=headers,exc_info=exc_info)
+            return body.append
+
+        app_iter = self.wsgi_app(environ,capture_start_response)
+        if not response:
+            return app_iter
+        return self.compress(app_iter,body,encoding,response,start_response)
+
+    def compress(self,app_iter,body,encoding,response,start_response):
+        '''
+        Iterate app_iter, holding the body back until it reaches min_size bytes, then start the response and
+        compress the rest of the body as it comes
+        '''
+        headers = response['headers']
+        try:
+            size = sum(len(chunk) for chunk in body)
+            chunks = iter(app_iter)
+            for chunk in chunks:
+                body.append(chunk)
+                size += len(chunk)
+                if size >= self.min_size:
+                    break
+            else:
+                # The whole body came through below min_size, send it as it is
+                if size < self.min_size:
+                    headers['Content-Length'] = str(size)
+                    start_response(response['status'],headers.to_wsgi_list(),response['exc_info'])
+                    yield b''.join(body)
+                    return
+            compress,finish = self.compressor(encoding)
+            headers.remove('Content-Length')
+            headers['Content-Encoding'] = encoding
+            # The compressed bytes differ from the uncompressed ones, so only a weak validator still holds
+            etag = headers.get('ETag')
+            if etag is not None and not etag.startswith('W/'):
+                headers['ETag'] = 'W/' + etag
+            start_response(response['status'],headers.to_wsgi_list(),response['exc_info'])
+            for chunk in chain(body,chunks):
+                compressed = compress(chunk)
+                if compressed:
+                    yield compressed
+            yield finish()
+        finally:
+            if hasattr(app_iter,'close'):
+                app_iter.close()
+
+# PASSWORD HASHING
+class HashingPool:
+    '''
+    Bounded pool of threads that runs bcrypt off the request thread. bcrypt releases the GIL while it works so
+    one thread per core keeps every core busy without letting a burst of logins take over the workers.
+    At most workers + queue_limit jobs are admitted at once, a job past that raises ServiceUnavailable straight
+    away instead of queueing behind the others.
+    '''
+    def __init__(self,workers,queue_limit):
+        self._executor = ThreadPoolExecutor(max_workers=workers,thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+
+    def run(self,func,*args):
+        '''
+        Run func(*args) on the pool and wait for its result
+        '''
+        if not self._slots.acquire(blocking=False):
+            raise werkzeug_exceptions.ServiceUnavailable
+        def job():
+            try:
+                return func(*args)
+            finally:
+                self._slots.release()
+        try:
+            future = self._executor.submit(job)
+        except(RuntimeError):
+            self._slots.release()
+            raise
+        return future.result()
+
+def hash_password(password):
+    '''
+    Hash a password on the hashing pool with the configured bcrypt work factor
+    '''
+    salt = bcrypt.gensalt(current_app.config['BCRYPT_ROUNDS'])
+    start = time.perf_counter()
+    try:
+        return current_app.extensions['hashing_pool'].run(bcrypt.hashpw,password.encode('utf-8'),salt)
+    finally:
+        observe_hash_time('hash',time.perf_counter() - start)
+
+def check_password(password,hashed_password):
+    '''
+    Compare a password against a stored bcrypt hash on the hashing pool
+    '''
+    start = time.perf_counter()
+    try:
+        return current_app.extensions['hashing_pool'].run(bcrypt.checkpw,password.encode('utf-8'),hashed_password)
+    finally:
+        observe_hash_time('check',time.perf_counter() - start)
+
+def observe_hash_time(operation,seconds):
+    '''
+    Observe the time a password hash or check took, as seen by the request waiting on it
+    '''
+    current_app.extensions['metrics'].hash_seconds.observe(seconds,operation)
+    add_request_time('hash_seconds',seconds)
+
+def needs_rehash(hashed_password):
+    '''
+    True when a stored bcrypt hash ($2b$<cost>$...) was made with a work factor other than the configured one
+    '''
+    return int(hashed_password.split(b'$')[2]) != current_app.config['BCRYPT_ROUNDS']
+
+# CONSTRAINT VIOLATIONS
+def violated_constraint(error):
+    '''
+    Name of the constraint an IntegrityError violated, read from the Postgres error diagnostics.
+    Falls back to the error message for drivers that do not report it
+    '''
+    diagnostics = getattr(error.orig,'diag',None)
+    return getattr(diagnostics,'constraint_name',None) or str(error.orig)
+
+# SIGNING KEYS
+class RotatingSessionInterface(SecureCookieSessionInterface):
+    '''
+    Cookie sessions signed with SECRET_KEY that still accept cookies signed with any of SECRET_KEY_FALLBACKS,
+    so keys can be rotated without logging everybody out
+    '''
+    def get_signing_serializer(self,app):
+        if not app.secret_key:
+            return None
+        signer_kwargs = dict(key_derivation=self.key_derivation,digest_method=self.digest_method)
+        # itsdangerous signs with the last key of the list and verifies with every one of them
+        secret_keys = [*reversed(app.config['SECRET_KEY_FALLBACKS']),app.secret_key]
+        return URLSafeTimedSerializer(secret_keys,salt=self.salt,serializer=self.serializer,
+            signer_kwargs=signer_kwargs)
+
+def encode_token(claims):
+    '''
+    Sign a jwt with the current SECRET_KEY
+    '''
+    return jwt.encode(claims,current_app.config['SECRET_KEY'],algorithm="HS256")
+
+def decode_token(token):
+    '''
+    Verify and decode a jwt signed with SECRET_KEY or any of SECRET_KEY_FALLBACKS
+    '''
+    *fallbacks,oldest = [current_app.config['SECRET_KEY'],*current_app.config['SECRET_KEY_FALLBACKS']]
+    for secret_key in fallbacks:
+        try:
+            return jwt.decode(token,secret_key,algorithms=["HS256"])
+        except(jwt.InvalidSignatureError):
+            continue
+    return jwt.decode(token,oldest,algorithms=["HS256"])
+
+# TOKEN REVOCATION
+class TokenDenylist:
+    '''
+    In-memory set of revoked token ids (the jti claim) with the unix time each token expires at.
+    An id is only kept until its token expires, the exp claim rejects the token from then on.
+    Checking a token is a single dict lookup that allocates nothing. Expired ids are purged from a heap ordered by
+    expiry whenever a token is revoked.
+    '''
+    def __init__(self):
+        self.watermark = None
+        self._expires_at = {}
+        self._by_expiry = []
+        self._next_sync = 0.0
+        self._lock = threading.Lock()
+
+    def __contains__(self,jti):
+        return jti in self._expires_at
+
+    def __len__(self):
+        return len(self._expires_at)
+
+    def revoke(self,jti,expires_at):
+        '''
+        Deny the token with id jti until expires_at
+        '''
+        with self._lock:
+            if jti not in self._expires_at:
+                self._expires_at[jti] = expires_at
+                heapq.heappush(self._by_expiry,(expires_at,jti))
+            now = time.time()
+            while self._by_expiry and self._by_expiry[0][0] <= now:
+                self._expires_at.pop(heapq.heappop(self._by_expiry)[1],None)
+
+    def sync_due(self,interval):
+        '''
+        True at most once every interval seconds, for the thread that should pull from the shared store
+        '''
+        now = time.monotonic()
+        if now < self._next_sync:
+            return False
+        with self._lock:
+            if now < self._next_sync:
+                return False
+            self._next_sync = now + interval
+            return True
+
+def revoke_token(data):
+    '''
+    Revoke the decoded token data in this process and, when it is on, in the shared store.
+    Tokens issued before tokens carried an id are never accepted by load_principal, so there is nothing to revoke
+    '''
+    if 'jti' not in data or 'exp' not in data:
+        return
+    current_app.extensions['token_denylist'].revoke(data['jti'],data['exp'])
+    if current_app.config['REVOCATION_SHARED']:
+        expires_at = datetime.fromtimestamp(data['exp'],timezone.utc).replace(tzinfo=None)
+        db.session.query(RevokedToken).filter(RevokedToken.expires_at < datetime.utcnow()).delete()
+        db.session.merge(RevokedToken(jti=data['jti'],expires_at=expires_at))
+        db.session.commit()
+
+def sync_revoked_tokens():
+    '''
+    Pull the tokens other processes revoked into the local denylist when the shared store is on.
+    Runs at most once every REVOCATION_SYNC_INTERVAL seconds. Each pull re-reads one interval before the newest
+    revocation already seen, so revocations committed late are not missed
+    '''
+    denylist = current_app.extensions['token_denylist']
+    interval = current_app.config['REVOCATION_SYNC_INTERVAL']
+    if not current_app.config['REVOCATION_SHARED'] or not denylist.sync_due(interval):
+        return
+    query = (db.session.query(RevokedToken.jti,RevokedToken.expires_at,RevokedToken.revoked_at)
+        .filter(RevokedToken.expires_at > datetime.utcnow()))
+    if denylist.watermark is not None:
+        query = query.filter(RevokedToken.revoked_at > denylist.watermark - timedelta(seconds=interval))
+    for revoked in query:
+        denylist.revoke(revoked.jti,revoked.expires_at.replace(tzinfo=timezone.utc).timestamp())
+        if denylist.watermark is None or revoked.revoked_at > denylist.watermark:
+            denylist.watermark = revoked.revoked_at
+
+# RATE LIMITING
+# Full buckets are deleted from the shared store at most this often, in seconds
+RATE_LIMIT_PURGE_INTERVAL = 60
+
+class RateLimiter:
+    '''
+    In-memory token buckets keyed by strings like 'ip:203.0.113.7'. A bucket holding up to burst tokens and gaining
+    one every interval seconds is kept as a single float, the unix time it is full again (the generic cell rate
+    algorithm), and a token can be spent while that time is less than burst intervals ahead.
+    A full bucket holds nothing worth keeping, so past max_keys buckets the least recently used are dropped.
+    rejected counts the requests turned away
+    '''
+    def __init__(self,max_keys):
+        self.max_keys = max_keys
+        self.rejected = 0
+        self._full_at = OrderedDict()
+        self._next_purge = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._full_at)
+
+    def take(self,limits,now=None):
+        '''
+        Spend a token from each bucket of limits, (key, interval, burst) triples, if every one of them has a token.
+        Returns 0 when the tokens were spent, otherwise the seconds until they all have one and nothing is spent
+        '''
+        now = time.time() if now is None else now
+        with self._lock:
+            retry_after = max(max(self._full_at.get(key,now),now) - now - (burst - 1) * interval
+                for key,interval,burst in limits)
+            if retry_after > 0:
+                return retry_after
+            for key,interval,_ in limits:
+                self._full_at[key] = max(self._full_at.get(key,now),now) + interval
+                self._full_at.move_to_end(key)
+            while len(self._full_at) > self.max_keys:
+                self._full_at.popitem(last=False)
+            return 0
+
+    def refund(self,limits):
+        '''
+        Give back the token take() spent from each bucket of limits, for an attempt turned away by the shared store
+        '''
+        with self._lock:
+            for key,interval,_ in limits:
+                if key in self._full_at:
+                    self._full_at[key] -= interval
+
+    def reject(self):
+        '''
+        Count a request turned away
+        '''
+        with self._lock:
+            self.rejected += 1
+
+    def clear(self):
+        '''
+        Forget every bucket, filling them all
+        '''
+        with self._lock:
+            self._full_at.clear()
+
+    def purge_due(self,interval):
+        '''
+        True at most once every interval seconds, for the thread that should purge the shared store
+        '''
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_purge:
+                return False
+            self._next_purge = now + interval
+            return True
+
+def take_shared(limits):
+    '''
+    Spend a token from each bucket of limits in the rate_limits table, all of them or none in one transaction.
+    Each bucket is spent with a single upsert that only writes when the bucket has a token, so concurrent
+    processes never overspend. Returns 0 when the tokens were spent, otherwise the seconds until they all have one
+    '''
+    now = time.time()
+    with db.engine.connect() as connection:
+        transaction = connection.begin()
+        for key,interval,burst in limits:
+            spent = connection.execute(text('''
+                INSERT INTO rate_limits (bucket, full_at) VALUES (:bucket, :now + :interval)
+                ON CONFLICT (bucket) DO UPDATE SET full_at = greatest(rate_limits.full_at, :now) + :interval
+                WHERE greatest(rate_limits.full_at, :now) - :now <= :burst_seconds
+                RETURNING full_at
+            '''),{'bucket':key,'now':now,'interval':interval,'burst_seconds':(burst - 1) * interval}).first()
+            if spent is None:
+                transaction.rollback()
+                full_at = dict(connection.execute(text('SELECT bucket, full_at FROM rate_limits WHERE bucket IN :keys')
+                    .bindparams(bindparam('keys',expanding=True)),{'keys':[key for key,_,_ in limits]}).all())
+                return max(max(max(full_at.get(key,now),now) - now - (burst - 1) * interval for key,interval,burst
+                    in limits),1)
+        if current_app.extensions['rate_limiter'].purge_due(RATE_LIMIT_PURGE_INTERVAL):
+            connection.execute(text('DELETE FROM rate_limits WHERE full_at < :now'),{'now':now})
+        transaction.commit()
+    return 0
+
+def throttle(account):
+    '''
+    Turn away a login or registration before any password is hashed or user is looked up when the client IP or
+    the account e-mail has run out of tokens. Buckets are checked in memory first, then in the shared store when
+    it is on. An attempt the shared store turns away gets its local tokens back, so it is not counted twice.
+    Raises TooManyRequests carrying the whole seconds to wait
+    '''
+    config = current_app.config
+    if not config['RATE_LIMIT']:
+        return
+    limits = (
+        (f'ip:{request.remote_addr}',60 / config['RATE_LIMIT_IP_PER_MINUTE'],config['RATE_LIMIT_IP_BURST']),
+        (f'account:{account.strip().lower()[:200]}',60 / config['RATE_LIMIT_ACCOUNT_PER_MINUTE'],
+            config['RATE_LIMIT_ACCOUNT_BURST']),
+    )
+    limiter = current_app.extensions['rate_limiter']
+    retry_after = limiter.take(limits)
+    if not retry_after and config['RATE_LIMIT_SHARED']:
+        retry_after = take_shared(limits)
+        if retry_after:
+            limiter.refund(limits)
+    if retry_after:
+        limiter.reject()
+        raise werkzeug_exceptions.TooManyRequests(retry_after=math.ceil(retry_after))
+
 # MIDDLEWARE
+class Principal(NamedTuple):
+    '''
+    The logged in user making a request, as carried by the claims of the session jwt
+    '''
+    user_id: int
+    username: str
+    admin_status: bool
+
+def load_principal():
+    '''
+    Decode the session jwt once per request and keep the resulting Principal on flask.g.
+    Raises Forbidden when the session has no token and Unauthorized when the token is not a login token or has
+    been revoked. jwt errors for invalid or expired tokens are left to the caller
+    '''
+    if 'principal' in g:
+        return g.principal
+    if 'token' not in session:
+        raise werkzeug_exceptions.Forbidden
+    data = decode_token(session['token'])
+    if not data or data.get('user_login_status') is not True or 'user_id' not in data or 'jti' not in data:
+        raise werkzeug_exceptions.Unauthorized
+    sync_revoked_tokens()
+    if data['jti'] in current_app.extensions['token_denylist']:
+        raise werkzeug_exceptions.Unauthorized
+    g.principal = Principal(data['user_id'],data['username'],data.get('admin_status') is True)
+    return g.principal
+
+def session_principal():
+    '''
+    The Principal of a logged in session for pages anyone can see, None for guests.
+    Sessions with a missing token are logged and treated as guests. Sessions whose token is invalid, expired or
+    signed with a retired key are cleared as well
+    '''
+    if 'user_login_status' not in session or session['user_login_status'] is False:
+        return None
+    try:
+        if 'token' not in session:
+            raise werkzeug_exceptions.Unauthorized
+        # Decode token ... I may expect some errors here
+        return load_principal()
+    except(werkzeug_exceptions.Unauthorized) as error:
+        feed_log.info('User with user login status true does not have a token in session storage',
+            extra={'error':str(error)})
+    except(jwt.InvalidTokenError) as error :
+        feed_log.warning('User token is invalid or has expired',extra={'error':str(error)})
+        session.clear()
+    return None
+
 def auth_token(func):
     '''
     Middleware function used to determine if has a jwt authenticating login.
+    The token is decoded once and the Principal is left on flask.g for the route.
     If middleware detects an invalid,expired, or nonexistant token, redirect to login
     '''
     @wraps(func)
@@ -83,79 +1766,161 @@ def auth_token(func):
         Decorater function to wrap middleware
         '''
         try :
-            # Verify token is not null
-            if 'token' not in session:
-                raise werkzeug_exceptions.Forbidden
-
-            # Number of things can go wrong here
-            #Test for jwt here
-            data = jwt.decode(session['token'],app.config['SECRET_KEY'],algorithms=["HS256"])
-            if not data or not 'user_login_status' in data or data['user_login_status'] is False:
-                raise werkzeug_exceptions.Unauthorized
+            load_principal()
             return func(*args,**kwargs)
         except(werkzeug_exceptions.Forbidden) as error:
-            print(error)
-            print('Client is missing token')
+            auth_log.warning('Client is missing token',extra={'error':str(error)})
             return render_template('login.html'),401
         except(werkzeug_exceptions.Unauthorized) as error:
-            print(error)
-            print('Unauthorized login')
+            auth_log.warning('Unauthorized login',extra={'error':str(error)})
+            return render_template('login.html'),401
+        except(jwt.InvalidTokenError) as error:
+            auth_log.warning('Client token is invalid or has expired',extra={'error':str(error)})
             return render_template('login.html'),401
     return decorated
 
 # ROUTES
+bp = Blueprint('blog',__name__)
 
-@app.route('/')
+@bp.route('/')
 def root():
     '''
     Root directory route.
     Re-routed to '/home'
     '''
-    return redirect(url_for('home'))
+    return redirect(url_for('blog.home'))
 
-@app.route('/home')
+@bp.route('/home')
 
 def home():
     '''
     Home route
-    Queries databse for all posts then checks whether session 'user_login_status' is True and a jwt exists.
-    If it is true and a jwt exists the token is decoded and the username is configured with the page to match
-    ownership to posts. If either fails load without post ownership and create post features.
+    Reads the feed version first. Checks whether session 'user_login_status' is True and a jwt exists, if so the
+    token is decoded and the username is configured with the page to match ownership to posts. If either fails
+    load without post ownership and create post features.
+    Clients that already hold the page at the current feed version are answered 304 before any post is read.
+    Otherwise reads one page of posts, newest first, through the feed cache. The 'before' and 'after' query
+    parameters hold the cursors of the older and newer pages.
+    Guests are served the cached rendering of the page, logged in users render the cached page data with their
+    own post controls.
     '''
     try :
-        # Query all Posts
-        posts= db.session.query(Post).order_by(Post.timestamp)
-
-        # If not logged in render template without logged in features
-        if 'user_login_status' not in session or session['user_login_status'] is False :
-            return render_template('home.html',posts=posts,loggedin=False,username='guest')
+        version,changed_at = feed_version()
+        etag = f"feed-{current_app.extensions['template_version']}-{version}"
 
         # If user is logged in check for token
-        if 'token' not in session:
-            raise werkzeug_exceptions.Unauthorized
-        # Decode token ... I may expect some errors here
-        # IMPLEMENT TESTS HERE #
-        data = jwt.decode(session['token'],app.config['SECRET_KEY'],algorithms=["HS256"])
-        username = data['username']
-        return render_template('home.html',posts=posts,loggedin=True,username=username)
-    except(werkzeug_exceptions.Unauthorized) as error:
-        print(error)
-        print ("User with user login status true does not have a token in session storage")
-        return render_template('home.html',posts=posts,loggedin=False,username ='guest')
-    except(jwt.ExpiredSignatureError) as error :
-        print(error)
-        print('User token has expired!')
-        return render_template('home.html',posts=posts,loggedin=False,username ='guest')
+        principal = session_principal()
+
+        # Logged in users get pages of their own, only their browser may keep them
+        cache_control = PUBLIC_CACHE_CONTROL
+        if principal is not None:
+            etag = f'{etag}-{principal.user_id}'
+            cache_control = PRIVATE_CACHE_CONTROL
+        if is_fresh(etag,changed_at):
+            return not_modified(etag,changed_at,cache_control)
+
+        # Fetch one page of posts
+        entry = cached_feed_page(request.args.get('before'),request.args.get('after'),version)
+        page = entry['page']
+
+        # If not logged in serve the cached guest rendering
+        if principal is None:
+            if entry['guest_html'] is None:
+                entry['guest_html'] = render_template('home.html',**page,loggedin=False,username='guest')
+            response = make_response(entry['guest_html'])
+        else:
+            response = make_response(render_template('home.html',**page,loggedin=True,username=principal.username))
+        return with_validators(response,etag,changed_at,cache_control)
+    except(werkzeug_exceptions.BadRequest) as error:
+        feed_log.info('Home request failed. The page cursor could not be decoded',extra={'error':str(error)})
+        return render_template('home.html',error='That page of posts could not be found'),400
+
+@bp.route('/users/<username>')
+def user_posts(username):
+    '''
+    Author page
+    Resolves the username to its author once, then reads one page of the author's posts, newest first, through the
+    index on (user_id, timestamp, id), so a page costs the same for an author of ten posts or of a million.
+    Takes the same 'before' and 'after' cursors as the home route. The post count is kept on the author row.
+    Clients that already hold the page at the current feed version are answered 304 before any post is read
+    '''
+    try:
+        version,changed_at = feed_version()
+        author = db.session.query(User.id,User.username,User.post_count).filter_by(username=username).first()
+        if author is None:
+            raise werkzeug_exceptions.NotFound
+        etag = f"author-{current_app.extensions['template_version']}-{version}-{author.id}"
+
+        principal = session_principal()
+        cache_control = PUBLIC_CACHE_CONTROL
+        if principal is not None:
+            etag = f'{etag}-{principal.user_id}'
+            cache_control = PRIVATE_CACHE_CONTROL
+        if is_fresh(etag,changed_at):
+            return not_modified(etag,changed_at,cache_control)
+
+        posts,older,newer = query_feed_page(request.args.get('before'),request.args.get('after'),user_id=author.id)
+        response = make_response(render_template('user.html',author=author,posts=posts,older=older,newer=newer,
+            loggedin=principal is not None,username=principal.username if principal is not None else 'guest'))
+        return with_validators(response,etag,changed_at,cache_control)
+    except(werkzeug_exceptions.NotFound) as error:
+        feed_log.info('Author page request failed. No user named %s exists',username,extra={'error':str(error)})
+        return render_template('home.html',error='That author could not be found'),404
+    except(werkzeug_exceptions.BadRequest) as error:
+        feed_log.info('Author page request failed. The page cursor could not be decoded',extra={'error':str(error)})
+        return render_template('home.html',error='That page of posts could not be found'),400
+
+@bp.route('/search')
+def search():
+    '''
+    Search route
+    Renders the search form, and when the 'q' query parameter holds search terms, one page of matching posts
+    ranked by relevance. The 'after' query parameter holds the cursor of the next page of results.
+    '''
+    terms = request.args.get('q','').strip()
+    try :
+        if terms == '':
+            return render_template('search.html',terms=terms)
+        results,more = query_search_page(terms,request.args.get('after'))
+        return render_template('search.html',terms=terms,results=results,more=more)
+    except(werkzeug_exceptions.BadRequest) as error:
+        feed_log.info('Search request failed. The page cursor could not be decoded',extra={'error':str(error)})
+        return render_template('search.html',terms=terms,error='That page of results could not be found'),400
 
-@app.route('/about')
+@bp.route('/assets/<path:filename>')
+def asset(filename):
+    '''
+    Fingerprinted asset route. Serves a built asset with far future caching, as its brotli or gzip variant when
+    the client accepts it and one was built
+    '''
+    build_dir = asset_build_dir(current_app)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding,suffix in ASSET_ENCODINGS:
+        variant = safe_join(build_dir,filename + suffix)
+        if request.accept_encodings[encoding] > 0 and variant is not None and os.path.isfile(variant):
+            response = send_from_directory(build_dir,filename + suffix,mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(build_dir,filename,mimetype=mimetype)
+    response.headers['Cache-Control'] = ASSET_CACHE_CONTROL
+    response.vary.add('Accept-Encoding')
+    return response
+
+@bp.route('/about')
 
 def about():
     '''
-    About route. Simply render the about page. No other logic present.
+    About route. Simply render the about page. The page only changes with the templates, so it is cached for
+    STATIC_PAGE_MAX_AGE seconds and answered 304 while the template version matches.
     '''
-    return render_template('about.html')
+    etag = f"about-{current_app.extensions['template_version']}"
+    cache_control = f'public, max-age={STATIC_PAGE_MAX_AGE}'
+    if is_fresh(etag):
+        return not_modified(etag,cache_control=cache_control)
+    return with_validators(make_response(render_template('about.html')),etag,cache_control=cache_control)
 
-@app.route('/login', methods=['GET','POST'])
+@bp.route('/login', methods=['GET','POST'])
 def login():
     '''
     Login route with post and get methods
@@ -182,45 +1947,84 @@ def login():
         if user_email =='' or password=='':
             raise werkzeug_exceptions.NotAcceptable
 
+        # Turn away clients and accounts past their rate before paying for a lookup and a bcrypt check
+        throttle(user_email)
+
         # Verify user exists in User table
         query_user = db.session.query(User).filter_by(email=user_email).first()
         if not query_user:
             raise IntegrityError
 
         # Authenticate password
-        if not bcrypt.checkpw(password.encode('utf-8'),query_user.password):
+        if not check_password(password,query_user.password):
             raise werkzeug_exceptions.Unauthorized
+
+        # Upgrade the stored hash when the configured work factor has changed
+        if needs_rehash(query_user.password):
+            query_user.password = hash_password(password)
+            db.session.commit()
         # ENCODE TOKEN
-        token = jwt.encode({
+        token = encode_token({
+            'jti':secrets.token_urlsafe(16),
+            'user_id':query_user.id,
             'username':query_user.username,
-            'exp': datetime.utcnow() + timedelta(hours=3),
+            'admin_status':query_user.admin_status is True,
+            'exp': datetime.utcnow() + timedelta(hours=current_app.config['TOKEN_LIFETIME_HOURS']),
             'user_login_status': True,
-        },app.config['SECRET_KEY'],algorithm="HS256")
+        })
 
         # SET SESSION ENV
         session['token'] = token
         session['user_login_status'] = True
 
-        # Go to admin page for admin users
+        # Go to the user directory for admin users
         if query_user.admin_status is True:
             session['admin_status'] = True
-            query_all_users= db.session.query(User.username,User.email).all()
-            return render_template('admin.html',users=query_all_users),302
+            return redirect(url_for('blog.admin_users'))
         #Else redirect to home page
-        return redirect(url_for('home'))
+        return redirect(url_for('blog.home'))
     except(werkzeug_exceptions.NotAcceptable) as error:
-        print (error)
-        print('Post request failed because either the form data was null or an empty string')
+        auth_log.info('Post request failed because either the form data was null or an empty string',
+            extra={'error':str(error)})
         return render_template('login.html',error='Please complete all fields to login'),406
     except(IntegrityError) as error:
-        print(error)
-        print("Post request failed No user exists by that email")
+        auth_log.warning('Post request failed No user exists by that email',extra={'error':str(error)})
         return render_template('login.html',error='Username and password could not be verified'),401
     except(werkzeug_exceptions.Unauthorized) as error:
-        print(error)
-        print("Post request failed Username and password could not be verified")
+        auth_log.warning('Post request failed Username and password could not be verified',extra={'error':str(error)})
         return render_template('login.html',error='Username and password could not verified'),401
-@app.route('/register',methods=['POST','GET'])
+    except(werkzeug_exceptions.ServiceUnavailable) as error:
+        auth_log.warning('Post request failed. The password hashing queue is full',extra={'error':str(error)})
+        busy_error = 'We are busy right now, please try again shortly'
+        return render_template('login.html',error=busy_error),503,{'Retry-After':'1'}
+    except(werkzeug_exceptions.TooManyRequests) as error:
+        auth_log.warning('Post request failed. Too many login attempts from %s',request.remote_addr,
+            extra={'error':str(error)})
+        throttled_error = f'Too many attempts, please try again in {error.retry_after} seconds'
+        return render_template('login.html',error=throttled_error),429,{'Retry-After':str(error.retry_after)}
+
+def insert_user(user_name,user_password,user_email):
+    '''
+    Add a user with a single INSERT. The unique constraints tell whether the email or the username is already
+    taken, either raises Conflict with the feedback for the register page as its description
+    '''
+    db.session.add(User(username=user_name,password=user_password,email=user_email))
+    try:
+        db.session.commit()
+    except(sqlalchemy_exceptions.IntegrityError) as error:
+        db.session.rollback()
+        constraint = violated_constraint(error)
+        if 'email' in constraint:
+            auth_log.info('User POST request failed email already exists with an account on database',
+                extra={'error':str(error)})
+            raise werkzeug_exceptions.Conflict('E-mail is already registered please sign in') from error
+        if 'username' in constraint:
+            auth_log.info('User POST request failed. The username %s already exists',user_name,
+                extra={'error':str(error)})
+            raise werkzeug_exceptions.Conflict('Username is already taken') from error
+        raise
+
+@bp.route('/register',methods=['POST','GET'])
 def register():
     '''
     Register route, accepts POST and GET methods.
@@ -228,9 +2032,9 @@ def register():
     A post method first checks if all required fields are not null and not empty
     Then checks if the email address ends in .com. If not : provide feedback
     Then checks for matching password and confirm password fields. If failure provide feedback
-    If success check if username or email exists in databse. If it does provide feedback
-    Finally check if the password is longer than 6 characters if it is. Add new user to databse and
-    redirect to login page. Otherwise provide error feedback
+    Then check if the password is longer than 6 characters. Otherwise provide error feedback
+    Finally add new user to databse with a single INSERT and redirect to login page. If the unique constraint on
+    the username or email is violated the username or email exists in databse, provide feedback
     '''
     try :
         # FOR GET REQUEST RENDER TEMPLATE
@@ -260,54 +2064,55 @@ def register():
         # Verify the password is at least six characters
         if len(user_password) < 6:
             raise werkzeug_exceptions.Unauthorized
-         # Verify email is not already with a user in db
-        if db.session.query(User).filter_by(email=user_email).count()!=0:
-            raise werkzeug_exceptions.Conflict
-        # Verify username is not taken
-        if db.session.query(User).filter_by(username=user_name).count()!=0:
-            raise IntegrityError
+
+        # Turn away clients and accounts past their rate before paying for a bcrypt hash
+        throttle(user_email)
 
         #Hash password and create user
-        user_password = bcrypt.hashpw(user_password.encode('utf-8'),bcrypt.gensalt())
-        new_user = User(username=user_name,password=user_password,email=user_email)
-        db.session.add(new_user)
-        db.session.commit()
-        return redirect(url_for('login'))
+        insert_user(user_name,hash_password(user_password),user_email)
+        return redirect(url_for('blog.login'))
     except(werkzeug_exceptions.NotAcceptable) as error:
-        print (error)
-        print('/login POST request failed. Either the form data was null or empty strings')
+        auth_log.info('/login POST request failed. Either the form data was null or empty strings',
+            extra={'error':str(error)})
         return render_template('register.html',error='Please do not leave any fields blank'),406
     except(werkzeug_exceptions.Forbidden) as error:
-        print(error)
-        print('User POST request failed. Passwords do not match')
+        auth_log.info('User POST request failed. Passwords do not match',extra={'error':str(error)})
         return render_template('register.html',error='The passwords must match'),406
     except(werkzeug_exceptions.BadRequest) as error:
-        print(error)
-        print('User POST request failed. Email does not end in .com suffix')
+        auth_log.info('User POST request failed. Email does not end in .com suffix',extra={'error':str(error)})
         return render_template('register.html',error='Please enter a valid E-mail address'),406
     except(werkzeug_exceptions.Unauthorized) as error:
-        print(error)
-        print('The POST request failed. The password is too short ')
+        auth_log.info('The POST request failed. The password is too short',extra={'error':str(error)})
         return render_template('register.html',error='The password must be at least six characters'),406
     except(werkzeug_exceptions.Conflict) as error:
-        print(error)
-        print("User POST request failed email already exists with an account on database")
-        return render_template('register.html',error='E-mail is already registered please sign in'),406
-    except(IntegrityError) as error:
-        print(error)
-        print(f"User POST request failed. The username {user_name} already exists")
-        return render_template('register.html',error='Username is already taken'),406
+        return render_template('register.html',error=error.description),406
+    except(werkzeug_exceptions.ServiceUnavailable) as error:
+        auth_log.warning('User POST request failed. The password hashing queue is full',extra={'error':str(error)})
+        busy_error = 'We are busy right now, please try again shortly'
+        return render_template('register.html',error=busy_error),503,{'Retry-After':'1'}
+    except(werkzeug_exceptions.TooManyRequests) as error:
+        auth_log.warning('User POST request failed. Too many registrations from %s',request.remote_addr,
+            extra={'error':str(error)})
+        throttled_error = f'Too many attempts, please try again in {error.retry_after} seconds'
+        return render_template('register.html',error=throttled_error),429,{'Retry-After':str(error.retry_after)}
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     '''
-    Logout route. Simply refreshes the session by reconfiguring the secret key. Users are logged out and
-    users are redirected to home page.
+    Logout route. Revokes the session token so it can not be replayed, then clears the session.
+    Only this token is revoked, the other sessions of the user and everybody else stay logged in.
+    Users are logged out and users are redirected to home page.
     '''
-    app.config['SECRET_KEY'] = secrets.token_urlsafe(12)
-    return redirect(url_for('home'))
+    try:
+        if 'token' in session:
+            revoke_token(decode_token(session['token']))
+    except(jwt.InvalidTokenError) as error:
+        # Invalid or expired tokens are rejected anyway, there is nothing to revoke
+        auth_log.info('Logout with an invalid or expired token, there is nothing to revoke',extra={'error':str(error)})
+    session.clear()
+    return redirect(url_for('blog.home'))
 
-@app.route('/posts/new',methods=['POST','GET'])
+@bp.route('/posts/new',methods=['POST','GET'])
 @auth_token
 def create_post():
     '''
@@ -315,8 +2120,7 @@ def create_post():
     After running middleware, check again for login status in session. Redirect to login in case of breach.
     Then if GET request simply render create post page.
     If POST request Verify the data is not null and not empty strings. If failure provide feedback otherwise
-    decode token to retreive username and create new post with Post class. Bind post to user and add post to
-    databse
+    create new post with Post class bound to the user id of the request principal and add post to databse
     '''
     try :
         #Verify user is logged in
@@ -338,31 +2142,29 @@ def create_post():
         if  title == '' or body == '':
             raise werkzeug_exceptions.NotAcceptable
 
-        # No need to test this function will only run after already being decoded
-        data = jwt.decode(session['token'],app.config['SECRET_KEY'],algorithms=["HS256"])
-        username = data['username']
-        user = db.session.query(User).filter_by(username=username).first()
-        new_post = Post(title=title,body=body,timestamp=datetime.utcnow())
-        user.posts.append(new_post)
+        # The middleware has already decoded the token into the request principal
+        new_post = Post(title=title,body=body,timestamp=datetime.utcnow(),user_id=g.principal.user_id)
         db.session.add(new_post)
+        count_posts(g.principal.user_id,1)
+        bump_feed_version()
         db.session.commit()
-        return redirect(url_for('home'))
+        current_app.extensions['feed_cache'].invalidate()
+        return redirect(url_for('blog.home'))
     except(werkzeug_exceptions.Unauthorized) as error:
-        print(error)
-        print('A user who has not logged in tried to post to the create_post route')
+        posts_log.warning('A user who has not logged in tried to post to the create_post route',
+            extra={'error':str(error)})
         return render_template('login'),401
     except(werkzeug_exceptions.NotAcceptable) as error:
-        print(error)
-        print('Post request failed. Either title or body was missing or null')
+        posts_log.info('Post request failed. Either title or body was missing or null',extra={'error':str(error)})
         return render_template('create_post.html',error='Please do not leave any fields blank'),406
-@app.route('/posts/<int:postid>/delete')
+@bp.route('/posts/<int:postid>/delete')
 @auth_token
 def delete_post(postid):
     '''
     Protected delete route.
     After running middleware check once more for login status in session.
     Query the post to delete from the databse. If not found, re-render homepage.
-    If found decode token and compare username in token to username relating to the post in database.
+    If found compare the user id of the request principal to the owner id of the post in database.
     If there is a breach redirect to login else delete the post from the databse.
     '''
     try :
@@ -374,25 +2176,31 @@ def delete_post(postid):
 
         if not post_to_delete:
             raise werkzeug_exceptions.NotFound
-        data = jwt.decode(session['token'],app.config['SECRET_KEY'],algorithms=["HS256"])
-        if post_to_delete.user.username != data['username']:
+        if post_to_delete.user_id != g.principal.user_id:
             raise werkzeug_exceptions.Forbidden
-        db.session.delete(post_to_delete)
+        # A concurrent delete of the same post may win between the load and here, only the rows this request
+        # removed are taken off the count
+        deleted = db.session.query(Post).filter(Post.id == postid,Post.user_id == g.principal.user_id).delete(
+            synchronize_session=False)
+        count_posts(g.principal.user_id,-deleted)
+        if deleted:
+            bump_feed_version()
         db.session.commit()
-        return redirect(url_for('home'))
+        if deleted:
+            current_app.extensions['feed_cache'].invalidate()
+        return redirect(url_for('blog.home'))
     except(werkzeug_exceptions.Unauthorized) as error:
-        print(error)
-        print(f" User {request.method} request failed User is not logged in")
+        posts_log.warning('User %s request failed User is not logged in',request.method,extra={'error':str(error)})
         return render_template('login'),401
     except(werkzeug_exceptions.NotFound) as error:
-        print(error)
-        print(f"User {request.method} request failed No post with id : {postid} exists")
+        posts_log.info('User %s request failed No post with id : %s exists',request.method,postid,
+            extra={'error':str(error)})
         return render_template('home.html'),404
     except(werkzeug_exceptions.Forbidden) as error:
-        print(error)
-        print(f" User {request.method} request failed User is attempting to delete a post that does not belong to them")
+        posts_log.warning('User %s request failed User is attempting to delete a post that does not belong to them',
+            request.method,extra={'error':str(error)})
         return render_template('login.html'),403
-@app.route('/posts/<int:postid>/edit',methods=['GET','POST'])
+@bp.route('/posts/<int:postid>/edit',methods=['GET','POST'])
 @auth_token
 def update_post(postid):
     '''
@@ -400,7 +2208,7 @@ def update_post(postid):
     After running middleware check again for login status in session.
     Then query the post to update and if GET request render edit post page with queries post.
     If post request, first verify required fields are non null and not empty strings. If otherwise provide
-    feedback. Then decode token and compare username in token to username relating to the post queried.
+    feedback. Then compare the user id of the request principal to the owner id of the post queried.
     If unauthorized redirect to login page. If authorized update the data in the databse and redirect to home.
     '''
     try :
@@ -425,29 +2233,373 @@ def update_post(postid):
         if body=='' or title=='':
             raise werkzeug_exceptions.NotAcceptable
 
-        data = jwt.decode(session['token'],app.config['SECRET_KEY'],algorithms=["HS256"])
-        if data['username'] != post_to_update.user.username:
+        if g.principal.user_id != post_to_update.user_id:
             raise werkzeug_exceptions.Forbidden
 
         post_to_update.title = title
         post_to_update.body = body
+        bump_feed_version()
         db.session.commit()
-        return redirect(url_for('home'))
+        current_app.extensions['feed_cache'].invalidate()
+        return redirect(url_for('blog.home'))
     except(werkzeug_exceptions.Unauthorized) as error:
-        print(error)
-        print(f" User {request.method} request failed User is not logged in")
-        return redirect(url_for('login',code=401,response=None))
+        posts_log.warning('User %s request failed User is not logged in',request.method,extra={'error':str(error)})
+        return redirect(url_for('blog.login',code=401,response=None))
     except(werkzeug_exceptions.NotFound) as error:
-        print(error)
-        print(f"User {request.method} request failed No post with id : {postid} exists")
+        posts_log.info('User %s request failed No post with id : %s exists',request.method,postid,
+            extra={'error':str(error)})
         return render_template('home.html',error='Post could not be found'),404
     except(werkzeug_exceptions.NotAcceptable) as error:
-        print(error)
-        print('Post request failed. Either title or body was missing or null')
+        posts_log.info('Post request failed. Either title or body was missing or null',extra={'error':str(error)})
         return render_template('update_post.html',error='Please do not leave any fields blank',post=post_to_update),406
     except(werkzeug_exceptions.Forbidden) as error:
-        print(error)
-        print("Update request failed. User is attempting to update a post that does not belong to them")
+        posts_log.warning('Update request failed. User is attempting to update a post that does not belong to them',
+            extra={'error':str(error)})
+        return render_template('login.html'),403
+@bp.route('/admin/users')
+@auth_token
+def admin_users():
+    '''
+    Protected admin user directory route.
+    After running middleware check the request principal is an admin, otherwise re-render login.
+    Renders one page of users ordered by username. The 'q' query parameter holds a prefix of the usernames or
+    emails to list and the 'after' query parameter the cursor of the page.
+    '''
+    try :
+        if not g.principal.admin_status:
+            raise werkzeug_exceptions.Forbidden
+        terms = request.args.get('q','').strip()
+        users,more = query_user_page(terms,request.args.get('after'))
+        return render_template('admin.html',users=users,terms=terms,more=more),200,{'Cache-Control':'private, no-store'}
+    except(werkzeug_exceptions.Forbidden) as error:
+        auth_log.warning('User directory request failed. The user is not an admin',extra={'error':str(error)})
         return render_template('login.html'),403
+
+@bp.route('/admin/users.csv')
+@auth_token
+def admin_users_csv():
+    '''
+    Protected admin user export route.
+    After running middleware check the request principal is an admin, otherwise re-render login.
+    Streams every user, or the users matching the 'q' prefix, as a CSV download without loading them all at once
+    '''
+    try :
+        if not g.principal.admin_status:
+            raise werkzeug_exceptions.Forbidden
+        terms = request.args.get('q','').strip()
+        return Response(stream_with_context(stream_users_csv(terms)),mimetype='text/csv',headers={
+            'Content-Disposition':'attachment; filename=users.csv',
+            'Cache-Control':'private, no-store',
+        })
+    except(werkzeug_exceptions.Forbidden) as error:
+        auth_log.warning('User export request failed. The user is not an admin',extra={'error':str(error)})
+        return render_template('login.html'),403
+
+@bp.route('/metrics')
+def metrics():
+    '''
+    Metrics route. The request, SQL, template and hashing metrics of this worker process along with its cache and
+    connection pool statistics, in the Prometheus text format
+    '''
+    return Response(current_app.extensions['metrics'].expose(current_app),
+        content_type='text/plain; version=0.0.4; charset=utf-8',headers={'Cache-Control':'no-store'})
+
+@bp.route('/healthz')
+def healthz():
+    '''
+    Liveness route. Answers as soon as the worker can serve requests and never touches the database
+    '''
+    return {'status':'ok'}
+
+@bp.route('/readyz')
+def readyz():
+    '''
+    Readiness route. Ready once the database answers and its schema is at the latest migration, until then
+    answer 503 so the orchestrator holds traffic back. A ready answer carries the connection pool statistics
+    '''
+    try:
+        use_primary()
+        version = db.session.execute(text('SELECT max(version) FROM schema_version')).scalar()
+    except(sqlalchemy_exceptions.OperationalError) as error:
+        db.session.rollback()
+        health_log.warning('Readiness check failed. The database could not be reached',extra={'error':str(error)})
+        return {'status':'unavailable','reason':'database unreachable'},503
+    except(sqlalchemy_exceptions.ProgrammingError) as error:
+        db.session.rollback()
+        health_log.warning('Readiness check failed. The database has not been migrated',extra={'error':str(error)})
+        return {'status':'unavailable','reason':'schema not migrated'},503
+    if version != migrations.LATEST_VERSION:
+        return {'status':'unavailable','reason':f'schema at version {version} of {migrations.LATEST_VERSION}'},503
+    replicas = current_app.extensions['replicas']
+    return {'status':'ready','schema_version':version,'pool':pool_stats(),
+        'replicas':{'healthy':replicas.healthy(),'total':len(replicas)}}
+
+# JSON API
+api = Blueprint('api',__name__,url_prefix='/api/v1')
+
+# Rows fetched from the database at a time while a page of posts is streamed
+API_FETCH_SIZE = 100
+
+def api_fields():
+    '''
+    The POST_FIELDS named by the comma separated 'fields' query parameter, every field when it is missing.
+    Unknown or missing field names raise a BadRequest
+    '''
+    if 'fields' not in request.args:
+        return tuple(POST_FIELDS)
+    fields = tuple(dict.fromkeys(name.strip() for name in request.args['fields'].split(',')))
+    if any(name not in POST_FIELDS for name in fields):
+        raise werkzeug_exceptions.BadRequest
+    return fields
+
+def api_page_size():
+    '''
+    The number of posts asked for by the 'limit' query parameter, API_PAGE_SIZE when it is missing.
+    Limits that are not a whole number from 1 to API_MAX_PAGE_SIZE raise a BadRequest
+    '''
+    try:
+        page_size = int(request.args.get('limit',current_app.config['API_PAGE_SIZE']))
+    except(ValueError) as error:
+        raise werkzeug_exceptions.BadRequest from error
+    if not 1 <= page_size <= current_app.config['API_MAX_PAGE_SIZE']:
+        raise werkzeug_exceptions.BadRequest
+    return page_size
+
+def api_post(row,fields):
+    '''
+    JSON ready dict of the fields of a post row, dates as ISO 8601 strings
+    '''
+    values = {name:getattr(row,name) for name in fields}
+    if 'timestamp' in values:
+        values['timestamp'] = values['timestamp'].isoformat()
+    return values
+
+def stream_posts_page(query,fields,page_size):
+    '''
+    Stream a page of posts read by a feed_query as the JSON object {"posts": [...], "next": cursor}, one post at
+    a time. Rows are fetched API_FETCH_SIZE at a time through a server side cursor, so neither the rows nor the
+    body of a large page are ever held whole in memory. next is the cursor of the following page, null on the last
+    '''
+    yield '{"posts":['
+    last = None
+    more = False
+    for count,row in enumerate(query.yield_per(API_FETCH_SIZE)):
+        # The row past the page only tells there is a next page
+        if count == page_size:
+            more = True
+            continue
+        yield (',' if last is not None else '') + json.dumps(api_post(row,fields))
+        last = row
+    yield '],"next":' + json.dumps(encode_cursor(last) if more else None) + '}'
+
+def posts_page_response(user_id=None):
+    '''
+    Streamed response of the page of posts after the 'cursor' query parameter, newest first, with the fields and
+    limit asked for, or 304 when the client holds it at the current feed version.
+    The query is built before the response starts, so a bad parameter raises a BadRequest here
+    '''
+    version,changed_at = feed_version()
+    etag = f'api-{version}'
+    if is_fresh(etag,changed_at):
+        return not_modified(etag,changed_at)
+    fields = api_fields()
+    page_size = api_page_size()
+    query = feed_query(request.args.get('cursor'),None,page_size,fields,user_id)
+    response = Response(stream_with_context(stream_posts_page(query,fields,page_size)),mimetype='application/json')
+    return with_validators(response,etag,changed_at)
+
+@api.route('/posts')
+def api_posts():
+    '''
+    Every post, newest first, one page at a time.
+    Query parameters: cursor, the next cursor of the previous page; limit, the number of posts of the page;
+    fields, the comma separated fields of each post (id, title, body, timestamp, user_id, username)
+    '''
+    try:
+        return posts_page_response()
+    except(werkzeug_exceptions.BadRequest) as error:
+        api_log.info('API request failed. The cursor, limit or fields could not be read',extra={'error':str(error)})
+        return {'error':'invalid cursor, limit or fields'},400
+
+@api.route('/posts/<int:postid>')
+def api_post_by_id(postid):
+    '''
+    A single post with the fields asked for by the fields query parameter, or 304 when the client holds it at the
+    current feed version
+    '''
+    try:
+        version,changed_at = feed_version()
+        etag = f'api-{version}'
+        if is_fresh(etag,changed_at):
+            return not_modified(etag,changed_at)
+        fields = api_fields()
+        post = posts_query(fields).filter(Post.id == postid).first()
+        if post is None:
+            raise werkzeug_exceptions.NotFound
+        return with_validators(make_response(api_post(post,fields)),etag,changed_at)
+    except(werkzeug_exceptions.BadRequest) as error:
+        api_log.info('API request failed. The fields could not be read',extra={'error':str(error)})
+        return {'error':'invalid fields'},400
+    except(werkzeug_exceptions.NotFound) as error:
+        api_log.info('API request failed. No post with id : %s exists',postid,extra={'error':str(error)})
+        return {'error':'post not found'},404
+
+@api.route('/users/<username>/posts')
+def api_user_posts(username):
+    '''
+    The posts of one user, newest first, one page at a time. Takes the same query parameters as /api/v1/posts
+    '''
+    try:
+        user_id = db.session.query(User.id).filter_by(username=username).scalar()
+        if user_id is None:
+            raise werkzeug_exceptions.NotFound
+        return posts_page_response(user_id)
+    except(werkzeug_exceptions.BadRequest) as error:
+        api_log.info('API request failed. The cursor, limit or fields could not be read',extra={'error':str(error)})
+        return {'error':'invalid cursor, limit or fields'},400
+    except(werkzeug_exceptions.NotFound) as error:
+        api_log.info('API request failed. No user named %s exists',username,extra={'error':str(error)})
+        return {'error':'user not found'},404
+
+# SCHEMA MIGRATIONS
+def hot_queries():
+    '''
+    The queries behind the busiest routes as (name, query) pairs, used to check their plans
+    '''
+    cursor = f'{date.today().isoformat()}_1'
+    page_size = current_app.config['FEED_PAGE_SIZE']
+    return (
+        ('feed first page',feed_query(None,None,page_size)),
+        ('feed older page',feed_query(cursor,None,page_size)),
+        ('feed newer page',feed_query(None,cursor,page_size)),
+        ('post by id',db.session.query(Post).filter(Post.id == 1)),
+        ('posts by user',feed_query(None,None,page_size,user_id=1)),
+        ('posts by user older page',feed_query(cursor,None,page_size,user_id=1)),
+        ('post search',search_query('blog',None,current_app.config['SEARCH_PAGE_SIZE'])),
+    )
+
+def find_sequential_scans():
+    '''
+    EXPLAIN every hot query with sequential scans discouraged and return the names of those whose plan still
+    scans the posts table sequentially, meaning no index can serve them
+    '''
+    sequential_scans = []
+    with db.engine.begin() as connection:
+        connection.execute(text('SET LOCAL enable_seqscan = off'))
+        for name,query in hot_queries():
+            compiled = query.statement.compile(dialect=connection.dialect)
+            plan = connection.exec_driver_sql(f'EXPLAIN {compiled}',compiled.params).scalars().all()
+            if any('Seq Scan on posts' in line for line in plan):
+                sequential_scans.append(name)
+    return sequential_scans
+
+db_cli = AppGroup('db',help='Manage the database schema.')
+
+@db_cli.command('upgrade')
+@click.option('--version','target',type=int,default=migrations.LATEST_VERSION,help='Version to upgrade to.')
+def db_upgrade(target):
+    '''
+    Upgrade the schema to the latest version
+    '''
+    click.echo(f'Schema at version {migrations.upgrade(db.engine,target)}')
+
+@db_cli.command('downgrade')
+@click.option('--version','target',type=int,required=True,help='Version to downgrade to.')
+def db_downgrade(target):
+    '''
+    Downgrade the schema to an earlier version
+    '''
+    click.echo(f'Schema at version {migrations.downgrade(db.engine,target)}')
+
+@db_cli.command('current')
+def db_current():
+    '''
+    Show the version the schema is at
+    '''
+    click.echo(f'Schema at version {migrations.current_version(db.engine)} of {migrations.LATEST_VERSION}')
+
+@db_cli.command('check-plans')
+def db_check_plans():
+    '''
+    Fail when a hot query falls back to a sequential scan of posts
+    '''
+    sequential_scans = find_sequential_scans()
+    for name in sequential_scans:
+        click.echo(f'Sequential scan in the plan of: {name}',err=True)
+    if sequential_scans:
+        raise click.exceptions.Exit(1)
+    click.echo('Every hot query is served by an index')
+
+# ASSET PIPELINE
+assets_cli = AppGroup('assets',help='Build the static assets.')
+
+@assets_cli.command('build')
+def assets_build():
+    '''
+    Fingerprint and precompress every static file and write the asset manifest
+    '''
+    manifest = build_assets(current_app)
+    click.echo(f'Built {len(manifest)} assets into {asset_build_dir(current_app)}')
+    if brotli is None:
+        click.echo('The brotli package is not installed, only gzip variants were built')
+
+# APPLICATION FACTORY
+def create_app(config=None):
+    '''
+    Application factory. Builds the app from DEFAULT_CONFIG updated with the environment and then with config,
+    then binds the database and registers the routes and commands. The database is not connected to until it is
+    first used, so workers boot straight away and /readyz tells the orchestrator when the database can take traffic.
+    '''
+    app = Flask(__name__)
+    app.session_interface = RotatingSessionInterface()
+    app.config.from_mapping(DEFAULT_CONFIG)
+    app.config.from_mapping(config_from_env())
+    if config:
+        app.config.from_mapping(config)
+    configure_logging(app.config)
+    if not app.config['SECRET_KEY']:
+        app.config['SECRET_KEY'] = secrets.token_urlsafe(32)
+        log.warning('SECRET_KEY is not set, sessions signed by this process will not be accepted by any other')
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',engine_options(app.config))
+    db.init_app(app)
+    app.extensions['feed_cache'] = FeedCache(app.config['FEED_CACHE_SIZE'],app.config['FEED_CACHE_TTL'])
+    app.extensions['metrics'] = Metrics()
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(assign_request_id)
+    app.after_request(send_request_id)
+    app.before_request(start_request_metrics)
+    app.after_request(record_response_status)
+    app.teardown_request(observe_request_metrics)
+    app.extensions['asset_manifest'] = load_asset_manifest(app)
+    app.extensions['template_version'] = template_version(app)
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.extensions['token_denylist'] = TokenDenylist()
+    app.extensions['rate_limiter'] = RateLimiter(app.config['RATE_LIMIT_MAX_KEYS'])
+    app.extensions['replicas'] = replica_set(app.config)
+    app.extensions['replicas'].start()
+    app.after_request(remember_writes)
+    if app.config['HASH_QUEUE_LIMIT'] is None:
+        app.config['HASH_QUEUE_LIMIT'] = 2 * app.config['HASH_WORKERS']
+    app.extensions['hashing_pool'] = HashingPool(app.config['HASH_WORKERS'],app.config['HASH_QUEUE_LIMIT'])
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app,x_for=app.config['TRUSTED_PROXIES'])
+    if app.config['COMPRESSION']:
+        app.wsgi_app = CompressionMiddleware(app.wsgi_app,app.config['COMPRESSION_MIN_SIZE'],
+            app.config['COMPRESSION_GZIP_LEVEL'],app.config['COMPRESSION_BROTLI_QUALITY'],
+            app.config['COMPRESSION_TYPES'])
+    app.register_blueprint(bp)
+    app.register_blueprint(api)
+    app.cli.add_command(db_cli)
+    app.cli.add_command(assets_cli)
+    app.cli.add_command(bulk.posts_cli)
+    app.cli.add_command(bulk.users_cli)
+    return app
+
+# Default application used by gunicorn, 'flask run' and the tests
+app = create_app()
+# Lets the models be used outside of an application context with the default application
+db.app = app
+
 if __name__=='__main__':
-    app.run(None,3000,True)
+    # Development server only, production runs under gunicorn with gunicorn.conf.py
+    app.run(None,3000,env_flag(os.environ.get('FLASK_DEBUG','false')))
@@ -0,0 +1,100 @@
+'''
+Benchmark of the response compression middleware on a realistic feed page.
+Renders home.html with a full page of posts of typical length, then runs it through CompressionMiddleware with
+each gzip level and brotli quality (when the brotli package is installed), both as a single body and streamed in
+chunks. Prints the CPU time each setting costs per page against the bytes it saves, as JSON.
+No database is needed: python benchmarks/compression.py
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import render_template  # pylint: disable=wrong-import-position
+from app import CompressionMiddleware, brotli, create_app  # pylint: disable=wrong-import-position
+
+WORDS = (
+    'the','a','and','of','to','in','is','it','that','was','for','on','with','as','we','today','blog','post','people',
+    'write','world','think','about','time','story','coffee','garden','travel','music','recipe','winter','summer',
+    'morning','friends','city','weekend','finally','really','little','first','again','still','never','always',
+)
+
+def feed_page(app,posts):
+    '''
+    The guest rendering of a feed page of posts with titles and bodies close to the column limits
+    '''
+    rng = random.Random(42)
+    rows = [SimpleNamespace(
+        id=posts - number,
+        title=' '.join(rng.choice(WORDS) for _ in range(8)).capitalize()[:65],
+        body=' '.join(rng.choice(WORDS) for _ in range(90))[:500],
+        timestamp=date(2022,7,1) - timedelta(days=number),
+        username=f'user{rng.randrange(1000)}',
+    ) for number in range(posts)]
+    with app.test_request_context('/home'):
+        return render_template('home.html',posts=rows,older='2022-01-01_1',newer=None,loggedin=False,
+            username='guest').encode('utf-8')
+
+def run(middleware,page,chunks,encoding):
+    '''
+    Run one request for page through middleware and return the bytes sent
+    '''
+    size = -(-len(page) // chunks)
+    def wsgi_app(environ,start_response):
+        headers = [('Content-Type','text/html; charset=utf-8')]
+        if chunks == 1:
+            headers.append(('Content-Length',str(len(page))))
+        start_response('200 OK',headers)
+        return [page[start:start + size] for start in range(0,len(page),size)]
+    environ = {'REQUEST_METHOD':'GET','HTTP_ACCEPT_ENCODING':encoding}
+    return b''.join(CompressionMiddleware(wsgi_app,middleware['min_size'],middleware['gzip_level'],
+        middleware['brotli_quality'],('text/html',))(environ,lambda status,headers,exc_info=None: None))
+
+def measure(page,chunks,encoding,runs,**middleware):
+    '''
+    CPU milliseconds per page and bytes sent for one compression setting
+    '''
+    sent = run(middleware,page,chunks,encoding)
+    start = time.process_time()
+    for _ in range(runs):
+        run(middleware,page,chunks,encoding)
+    cpu_ms = (time.process_time() - start) * 1000 / runs
+    return {
+        'cpu_ms_per_page':round(cpu_ms,4),
+        'bytes':len(sent),
+        'bytes_saved':len(page) - len(sent),
+        'ratio':round(len(sent) / len(page),4),
+        'bytes_saved_per_cpu_ms':round((len(page) - len(sent)) / cpu_ms) if cpu_ms else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts',type=int,default=20,help='Posts on the feed page, FEED_PAGE_SIZE by default.')
+    parser.add_argument('--chunks',type=int,default=20,help='Chunks the page is streamed in.')
+    parser.add_argument('--runs',type=int,default=500,help='Timed runs of each setting.')
+    args = parser.parse_args()
+    app = create_app({'SECRET_KEY':'benchmark'})
+    page = feed_page(app,args.posts)
+    settings = {'identity':('identity',{})}
+    for level in (1,6,9):
+        settings[f'gzip level {level}'] = ('gzip',{'gzip_level':level})
+    if brotli is not None:
+        for quality in (1,4,6,11):
+            settings[f'brotli quality {quality}'] = ('br',{'brotli_quality':quality})
+    results = {}
+    for name,(encoding,overrides) in settings.items():
+        middleware = {'min_size':500,'gzip_level':6,'brotli_quality':4,**overrides}
+        results[name] = {
+            'single body':measure(page,1,encoding,args.runs,**middleware),
+            'streamed':measure(page,args.chunks,encoding,args.runs,**middleware),
+        }
+    print(json.dumps({'page_bytes':len(page),'posts':args.posts,'runs':args.runs,'settings':results},indent=2))
+
+if __name__=='__main__':
+    main()
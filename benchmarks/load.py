@@ -0,0 +1,314 @@
+'''
+Load benchmark of the busiest routes on a large seeded database.
+Seeds the database at DATABASE_URL with --users users and --posts posts (only the missing ones) with bulk
+INSERT ... SELECT statements, then drives each route from --concurrency threads for --duration seconds, either
+in-process through the app's test client or against a running server given with --url. Prints the throughput and
+the p50/p95/p99 latency of each route as JSON. Save it with --output and pass it back with --baseline on a later
+commit to see the change of every figure.
+Run it against a disposable database, for example:
+    DATABASE_URL=postgresql://... python benchmarks/load.py --users 100000 --posts 5000000
+'''
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bcrypt  # pylint: disable=wrong-import-position
+from sqlalchemy import text  # pylint: disable=wrong-import-position
+import migrations  # pylint: disable=wrong-import-position
+from app import bump_feed_version, create_app, db, recount_posts  # pylint: disable=wrong-import-position
+
+# Password of every seeded user
+PASSWORD = 'benchmark'
+# Rows inserted per statement while seeding, so each transaction stays a manageable size
+SEED_BATCH = 250000
+ROUTES = ('home','home_deep','login','create_post','update_post','search','api_posts')
+
+WORDS = (
+    'blog','post','today','people','write','world','think','about','time','story','coffee','garden','travel',
+    'music','recipe','winter','summer','python','database','mountain','river','library','festival','telescope',
+    'harbour','lantern','meadow','orchard','quartz','saffron','tundra','violin','walrus','zeppelin',
+)
+
+def seed_users(users,rounds):
+    '''
+    Insert bench_user_<n> users, all with PASSWORD as their password, until there are users of them
+    '''
+    existing = db.session.execute(text(r"SELECT count(*) FROM users WHERE username LIKE 'bench\_user\_%'")).scalar()
+    password = bcrypt.hashpw(PASSWORD.encode('utf-8'),bcrypt.gensalt(rounds))
+    for first in range(existing + 1,users + 1,SEED_BATCH):
+        last = min(first + SEED_BATCH - 1,users)
+        db.session.execute(text('''
+            INSERT INTO users (username, password, email, admin_status)
+            SELECT 'bench_user_' || n, :password, 'bench_user_' || n || '@bench.com', false
+            FROM generate_series(:first, :last) AS n
+            ON CONFLICT DO NOTHING
+        '''),{'password':password,'first':first,'last':last})
+        db.session.commit()
+        print(f'Seeded users up to {last}',file=sys.stderr)
+
+def seed_posts(posts):
+    '''
+    Insert posts by the bench users until the posts table holds posts rows. Authors are skewed so a few users
+    write most of the posts, as on a real blog, and timestamps spread over ten years
+    '''
+    existing = db.session.execute(text('SELECT count(*) FROM posts')).scalar()
+    for first in range(existing + 1,posts + 1,SEED_BATCH):
+        last = min(first + SEED_BATCH - 1,posts)
+        db.session.execute(text('''
+            INSERT INTO posts (title, body, user_id, timestamp)
+            SELECT
+                initcap(words[1 + (n * 7) % cardinality(words)]) || ' ' || words[1 + (n * 13) % cardinality(words)],
+                array_to_string(ARRAY(
+                    SELECT words[1 + ((n * 7919 + i * 104729) % cardinality(words))]
+                    FROM generate_series(1, 40) AS i
+                ), ' '),
+                authors.ids[1 + floor(power(random(), 3) * cardinality(authors.ids))::int],
+                current_date - (n % 3650)::int
+            FROM generate_series(:first, :last) AS n,
+                (SELECT CAST(:words AS TEXT[]) AS words) AS vocabulary,
+                (SELECT array_agg(id) AS ids FROM users WHERE username LIKE 'bench\\_user\\_%') AS authors
+        '''),{'words':list(WORDS),'first':first,'last':last})
+        db.session.commit()
+        print(f'Seeded posts up to {last}',file=sys.stderr)
+    recount_posts()
+    bump_feed_version()
+    db.session.commit()
+
+def seed(app,users,posts):
+    '''
+    Migrate the database and seed it up to users users and posts posts
+    '''
+    with app.app_context():
+        migrations.upgrade(db.engine)
+        seed_users(users,app.config['BCRYPT_ROUNDS'])
+        seed_posts(posts)
+        db.session.execute(text('ANALYZE users'))
+        db.session.execute(text('ANALYZE posts'))
+        db.session.commit()
+
+class TestClientDriver:
+    '''
+    Sends requests to the app in-process through its test client, keeping the session cookie if cookies is set
+    '''
+    def __init__(self,app,cookies=True):
+        self.client = app.test_client(use_cookies=cookies)
+
+    def request(self,method,path,data=None):
+        '''
+        Send a request and return its status code
+        '''
+        return self.client.open(path,method=method,data=data).status_code
+
+class HttpDriver:
+    '''
+    Sends requests to a running server over one keep-alive connection, keeping the session cookie if cookies is set
+    '''
+    def __init__(self,url,cookies=True):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname,parts.port or 80,timeout=60)
+        self.cookies = cookies
+        self.cookie = None
+
+    def request(self,method,path,data=None):
+        '''
+        Send a request and return its status code
+        '''
+        headers = {'Content-Type':'application/x-www-form-urlencoded'} if data is not None else {}
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        self.connection.request(method,path,urlencode(data) if data is not None else None,headers)
+        response = self.connection.getresponse()
+        response.read()
+        cookie = response.getheader('Set-Cookie')
+        if cookie and self.cookies:
+            self.cookie = cookie.split(';',1)[0]
+        return response.status
+
+class User:
+    '''
+    A bench user driving the routes, logged in through its own driver, with the ids of posts it may edit.
+    Pages anyone can see and logins go through a guest driver without cookies, so they never change the session
+    '''
+    def __init__(self,driver,guest,number,post_ids):
+        self.driver = driver
+        self.guest = guest
+        self.number = number
+        self.post_ids = post_ids
+        self.rng = random.Random(number)
+
+    def login(self):
+        return self.driver.request('POST','/login',{'email':f'bench_user_{self.number}@bench.com',
+            'password':PASSWORD})
+
+    def scenario(self,route,users):
+        '''
+        The next request of route as (driver, method, path, data, expected statuses)
+        '''
+        if route == 'home':
+            return self.guest,'GET','/home',None,(200,)
+        if route == 'home_deep':
+            cursor = f'{date.today() - timedelta(days=self.rng.randrange(3650))}_{2 ** 31 - 1}'
+            return self.guest,'GET',f'/home?before={cursor}',None,(200,)
+        if route == 'login':
+            return self.guest,'POST','/login',{'email':f'bench_user_{self.rng.randrange(1,users + 1)}@bench.com',
+                'password':PASSWORD},(302,)
+        if route == 'create_post':
+            return self.driver,'POST','/posts/new',{'title':'Benchmark post',
+                'body':' '.join(self.rng.sample(WORDS,20))},(302,)
+        if route == 'update_post':
+            return self.driver,'POST',f'/posts/{self.rng.choice(self.post_ids)}/edit',{'title':'Benchmark edit',
+                'body':' '.join(self.rng.sample(WORDS,20))},(302,)
+        if route == 'search':
+            return self.guest,'GET',f'/search?q={self.rng.choice(WORDS)}',None,(200,)
+        return self.guest,'GET','/api/v1/posts?fields=id,title,timestamp',None,(200,)
+
+def percentile(latencies,fraction):
+    '''
+    Nearest rank percentile of sorted latencies
+    '''
+    return latencies[max(0,min(len(latencies) - 1,int(round(fraction * len(latencies))) - 1))]
+
+def run_route(route,bench_users,duration,users):
+    '''
+    Drive route from every bench user at once for duration seconds and summarise the latencies
+    '''
+    deadline = time.perf_counter() + duration
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+    def drive(user):
+        while time.perf_counter() < deadline:
+            driver,method,path,data,expected = user.scenario(route,users)
+            start = time.perf_counter()
+            try:
+                status = driver.request(method,path,data)
+            except(OSError,http.client.HTTPException) as error:
+                status = repr(error)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if status not in expected:
+                    errors.append(status)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(bench_users)) as executor:
+        list(executor.map(drive,bench_users))
+    wall = time.perf_counter() - start
+    latencies.sort()
+    if not latencies:
+        return {'requests':0,'errors':0}
+    return {
+        'requests':len(latencies),
+        'errors':len(errors),
+        'error_statuses':sorted({str(status) for status in errors})[:5],
+        'throughput_rps':round(len(latencies) / wall,2),
+        'p50_ms':round(percentile(latencies,0.50) * 1000,3),
+        'p95_ms':round(percentile(latencies,0.95) * 1000,3),
+        'p99_ms':round(percentile(latencies,0.99) * 1000,3),
+        'max_ms':round(latencies[-1] * 1000,3),
+    }
+
+def bench_users_for(app,args):
+    '''
+    One logged in bench user per thread, each with up to 20 of its posts to edit
+    '''
+    bench_users = []
+    for number in range(1,args.concurrency + 1):
+        driver = HttpDriver(args.url) if args.url else TestClientDriver(app)
+        guest = HttpDriver(args.url,cookies=False) if args.url else TestClientDriver(app,cookies=False)
+        with app.app_context():
+            post_ids = [row.id for row in db.session.execute(text('''
+                SELECT posts.id FROM posts JOIN users ON users.id = posts.user_id
+                WHERE users.username = :username ORDER BY posts.timestamp DESC, posts.id DESC LIMIT 20
+            '''),{'username':f'bench_user_{number}'})]
+        user = User(driver,guest,number,post_ids)
+        if user.login() != 302:
+            raise SystemExit(f'bench_user_{number} could not log in')
+        if not post_ids:
+            user.driver.request('POST','/posts/new',{'title':'Benchmark post','body':'Seed post to edit'})
+            with app.app_context():
+                user.post_ids = [db.session.execute(text('''
+                    SELECT max(posts.id) FROM posts JOIN users ON users.id = posts.user_id
+                    WHERE users.username = :username
+                '''),{'username':f'bench_user_{number}'}).scalar()]
+        bench_users.append(user)
+    return bench_users
+
+def compare(results,baseline):
+    '''
+    Percent change of every figure of results against the same figure of baseline
+    '''
+    changes = {}
+    for route,figures in results['routes'].items():
+        before = baseline.get('routes',{}).get(route)
+        if not before:
+            continue
+        changes[route] = {key:round((value - before[key]) / before[key] * 100,1)
+            for key,value in figures.items() if key.endswith(('_ms','_rps')) and before.get(key)}
+    return changes
+
+def git_commit():
+    '''
+    The commit of the working tree benchmarked, None outside of a git checkout
+    '''
+    try:
+        return subprocess.run(['git','rev-parse','--short','HEAD'],capture_output=True,text=True,check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except(OSError,subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users',type=int,default=100000,help='Number of bench users to seed.')
+    parser.add_argument('--posts',type=int,default=5000000,help='Number of posts to seed the table with.')
+    parser.add_argument('--skip-seed',action='store_true',help='Benchmark the database as it is.')
+    parser.add_argument('--routes',default=','.join(ROUTES),help=f'Comma separated routes out of {",".join(ROUTES)}.')
+    parser.add_argument('--concurrency',type=int,default=8,help='Threads driving each route at once.')
+    parser.add_argument('--duration',type=float,default=20,help='Seconds each route is driven for.')
+    parser.add_argument('--url',help='Base URL of a running server, the app is driven in-process when omitted.')
+    parser.add_argument('--output',help='File to write the results to as well.')
+    parser.add_argument('--baseline',help='Results of an earlier run to compare against.')
+    args = parser.parse_args()
+    routes = [route.strip() for route in args.routes.split(',') if route.strip()]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        parser.error(f'unknown routes: {", ".join(sorted(unknown))}')
+    # Keep the hashing queue and the login rate limits from turning the benchmark's logins away, it measures
+    # waiting instead
+    app = create_app({'HASH_QUEUE_LIMIT':max(64,args.concurrency * 2),'RATE_LIMIT':False})
+    if not args.skip_seed:
+        seed(app,args.users,args.posts)
+    bench_users = bench_users_for(app,args)
+    results = {
+        'commit':git_commit(),
+        'target':args.url or 'test client',
+        'users':args.users,
+        'posts':args.posts,
+        'concurrency':args.concurrency,
+        'duration_s':args.duration,
+        'routes':{},
+    }
+    for route in routes:
+        print(f'Driving {route}',file=sys.stderr)
+        results['routes'][route] = run_route(route,bench_users,args.duration,args.users)
+    if args.baseline:
+        with open(args.baseline,encoding='utf-8') as baseline:
+            results['change_percent'] = compare(results,json.load(baseline))
+    output = json.dumps(results,indent=2)
+    if args.output:
+        with open(args.output,'w',encoding='utf-8') as output_file:
+            output_file.write(output + '\n')
+    print(output)
+
+if __name__=='__main__':
+    main()
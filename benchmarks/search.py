@@ -0,0 +1,102 @@
+'''
+Benchmark of post search on a large seeded posts table.
+Seeds the database at DATABASE_URL with --posts generated posts (only the missing ones), then times the full text
+search behind /search against the ILIKE scan it replaces for a few terms of different frequency, and prints the
+timings in milliseconds as JSON.
+Run it against a disposable database, for example: DATABASE_URL=postgresql://... python benchmarks/search.py
+'''
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import or_, text  # pylint: disable=wrong-import-position
+import migrations  # pylint: disable=wrong-import-position
+from app import Post, create_app, db, recount_posts, search_query  # pylint: disable=wrong-import-position
+
+# Vocabulary of the generated posts, the position of a word sets how often it is used
+WORDS = (
+    'blog','post','today','people','write','world','think','about','time','story','coffee','garden','travel',
+    'music','recipe','winter','summer','python','database','mountain','river','library','festival','telescope',
+    'harbour','lantern','meadow','orchard','quartz','saffron','tundra','violin','walrus','zeppelin',
+)
+
+# Terms searched, from very common to rare
+TERMS = ('blog','garden','telescope','zeppelin','coffee recipe')
+
+def seed(posts):
+    '''
+    Insert generated posts until the table holds at least posts rows, with a single INSERT ... SELECT
+    '''
+    existing = db.session.query(Post).count()
+    if existing >= posts:
+        return existing
+    db.session.execute(text(
+        "INSERT INTO users (username, password, email) VALUES ('bench_author', '\\x00', 'bench_author@bench.com') "
+        'ON CONFLICT DO NOTHING'))
+    # Word i of post n is picked from a skewed spread of the vocabulary so term frequencies differ
+    db.session.execute(text('''
+        INSERT INTO posts (title, body, user_id, timestamp)
+        SELECT
+            initcap(words[1 + (n * 7) % 8]) || ' ' || words[1 + (n * 13) % cardinality(words)],
+            array_to_string(ARRAY(
+                SELECT words[1 + floor(power(((n * 7919 + i * 104729) % 1000) / 1000.0, 2) * cardinality(words))::int]
+                FROM generate_series(1, 40) AS i
+            ), ' '),
+            author.id,
+            current_date - (n % 3650)::int
+        FROM generate_series(:first, :last) AS n,
+            (SELECT CAST(:words AS TEXT[]) AS words) AS vocabulary,
+            (SELECT id FROM users WHERE username = 'bench_author') AS author
+    '''),{'words':list(WORDS),'first':existing + 1,'last':posts})
+    recount_posts()
+    db.session.commit()
+    db.session.execute(text('ANALYZE posts'))
+    db.session.commit()
+    return posts
+
+def time_query(query,runs):
+    '''
+    Run a query runs times and return its median and worst time in milliseconds
+    '''
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        query.all()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'median_ms':round(statistics.median(timings),3),'max_ms':round(max(timings),3)}
+
+def ilike_query(terms,page_size):
+    '''
+    The table scan search replaces: every word of terms anywhere in the title or body, newest first
+    '''
+    query = db.session.query(Post.id,Post.title,Post.body,Post.timestamp)
+    for word in terms.split():
+        pattern = f'%{word}%'
+        query = query.filter(or_(Post.title.ilike(pattern),Post.body.ilike(pattern)))
+    return query.order_by(Post.timestamp.desc(),Post.id.desc()).limit(page_size + 1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts',type=int,default=1000000,help='Number of posts to seed the table with.')
+    parser.add_argument('--runs',type=int,default=20,help='Timed runs of each query.')
+    args = parser.parse_args()
+    app = create_app()
+    with app.app_context():
+        migrations.upgrade(db.engine)
+        total = seed(args.posts)
+        page_size = app.config['SEARCH_PAGE_SIZE']
+        results = {}
+        for terms in TERMS:
+            results[terms] = {
+                'full_text':time_query(search_query(terms,None,page_size),args.runs),
+                'ilike':time_query(ilike_query(terms,page_size),args.runs),
+            }
+    print(json.dumps({'posts':total,'runs':args.runs,'terms':results},indent=2))
+
+if __name__=='__main__':
+    main()
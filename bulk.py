@@ -0,0 +1,250 @@
+'''
+Bulk import and export of posts and users through Postgres COPY, as the 'flask posts' and 'flask users' command
+groups. Files are CSV with a header line or JSON lines, one object per row, and are streamed both ways so memory
+use does not depend on their size. Imports go through a temporary staging table and a single INSERT ... SELECT in
+one transaction, so a bad file leaves the database untouched.
+'''
+import csv
+import io
+import os
+from datetime import datetime
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import text
+from sqlalchemy import exc as sqlalchemy_exceptions
+
+# Bytes COPY moves per read or write, and bytes between two progress reports
+BULK_CHUNK_SIZE = 1 << 20
+BULK_PROGRESS_BYTES = 64 << 20
+# Rows dumped by the export commands, authors are written by username so posts load into any database
+BULK_EXPORTS = {
+    'posts':'''SELECT posts.id, posts.title, posts.body, posts.timestamp, users.username
+        FROM posts LEFT JOIN users ON users.id = posts.user_id ORDER BY posts.id''',
+    'users':'SELECT id, username, email, password, admin_status FROM users ORDER BY id',
+}
+# Columns the import commands read, every other exported column is accepted and ignored
+BULK_IMPORT_COLUMNS = {
+    'posts':{'required':('title','body','username'),'optional':('id','timestamp')},
+    'users':{'required':('username','email','password'),'optional':('id','admin_status')},
+}
+# JSON lines go through COPY's csv format with quote and delimiter bytes JSON never holds unescaped, so each line
+# reaches the database untouched
+JSONL_COPY_OPTIONS = "(FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')"
+
+class CopyProgress:
+    '''
+    File object handed to COPY that passes data through to file and reports every BULK_PROGRESS_BYTES moved.
+    done starts at the bytes already consumed, such as a CSV header, and total is the file size when known
+    '''
+    def __init__(self,file,action,done=0,total=None):
+        self.file = file
+        self.action = action
+        self.done = done
+        self.total = total
+        self.next_report = done + BULK_PROGRESS_BYTES
+
+    def read(self,size=-1):
+        '''
+        Read up to size bytes from file, COPY ... FROM STDIN calls it for JSON lines and CSV bodies
+        '''
+        data = self.file.read(size)
+        self.advance(len(data))
+        return data
+
+    def readline(self,size=-1):
+        '''
+        Read a line from file
+        '''
+        data = self.file.readline(size)
+        self.advance(len(data))
+        return data
+
+    def write(self,data):
+        '''
+        Write data to file, COPY ... TO STDOUT calls it for every chunk
+        '''
+        self.file.write(data)
+        self.advance(len(data))
+
+    def advance(self,size):
+        '''
+        Count size more bytes moved, reporting once another BULK_PROGRESS_BYTES went through
+        '''
+        self.done += size
+        if self.done >= self.next_report:
+            self.next_report += BULK_PROGRESS_BYTES
+            self.report()
+
+    def report(self):
+        '''
+        Print the bytes moved so far to stderr, out of the file size when it is known
+        '''
+        progress = f'{self.done / (1 << 20):.0f} MB'
+        if self.total:
+            progress += f' of {self.total / (1 << 20):.0f} MB ({self.done * 100 // self.total}%)'
+        click.echo(f'{self.action} {progress}',err=True)
+
+def bulk_format(file,file_format):
+    '''
+    The format asked for, else jsonl for .jsonl and .ndjson files and csv for everything else
+    '''
+    if file_format:
+        return file_format
+    return 'jsonl' if getattr(file,'name','').endswith(('.jsonl','.ndjson')) else 'csv'
+
+def file_size(file):
+    '''
+    Size of a regular file, None for pipes and terminals
+    '''
+    try:
+        stat = os.fstat(file.fileno())
+    except(OSError,ValueError,io.UnsupportedOperation):
+        return None
+    return stat.st_size if stat.st_size > 0 else None
+
+def stage_rows(connection,table,file,file_format):
+    '''
+    COPY file into a temporary staging table dropped on commit, streaming it BULK_CHUNK_SIZE bytes at a time.
+    CSV files name their columns in a header line, JSON lines are staged whole as one json column.
+    Returns the staging table and the SQL expression reading each import column from it, NULL for absent ones
+    '''
+    columns = BULK_IMPORT_COLUMNS[table]
+    staging = f'{table}_import'
+    total = file_size(file)
+    cursor = connection.connection.cursor()
+    if file_format == 'jsonl':
+        connection.execute(text(f'CREATE TEMPORARY TABLE {staging} (doc JSON) ON COMMIT DROP'))
+        progress = CopyProgress(file,f'Read {table}',total=total)
+        cursor.copy_expert(f'COPY {staging} (doc) FROM STDIN WITH {JSONL_COPY_OPTIONS}',progress,BULK_CHUNK_SIZE)
+        # Blank lines are staged as NULL
+        connection.execute(text(f'DELETE FROM {staging} WHERE doc IS NULL'))
+        expressions = {name:f"staged.doc->>'{name}'" for name in (*columns['required'],*columns['optional'])}
+        return staging,expressions
+    header_line = file.readline()
+    header = next(csv.reader([header_line.decode('utf-8-sig')]),[])
+    unknown = set(header) - {*columns['required'],*columns['optional']}
+    missing = set(columns['required']) - set(header)
+    if unknown or missing or len(set(header)) != len(header):
+        raise click.ClickException(f'The CSV header must name the columns {", ".join(columns["required"])} and may '
+            f'name {", ".join(columns["optional"])}, it names {", ".join(header) or "nothing"}')
+    connection.execute(text(f'CREATE TEMPORARY TABLE {staging} ({", ".join(f"{name} TEXT" for name in header)}) '
+        'ON COMMIT DROP'))
+    progress = CopyProgress(file,f'Read {table}',done=len(header_line),total=total)
+    cursor.copy_expert(f'COPY {staging} ({", ".join(header)}) FROM STDIN WITH (FORMAT csv)',progress,BULK_CHUNK_SIZE)
+    expressions = {name:f'staged.{name}' if name in header else 'NULL'
+        for name in (*columns['required'],*columns['optional'])}
+    return staging,expressions
+
+def import_posts(connection,staging,columns):
+    '''
+    Insert the staged posts, resolving every author by username in one join, and add them to the post counts of
+    their authors. Posts of unknown authors are skipped. Returns the number of posts inserted
+    '''
+    return connection.execute(text(f'''
+        WITH inserted AS (
+            INSERT INTO posts (title, body, timestamp, user_id)
+            SELECT {columns['title']}, {columns['body']}, coalesce(CAST({columns['timestamp']} AS DATE), current_date),
+                users.id
+            FROM {staging} AS staged JOIN users ON users.username = {columns['username']}
+            RETURNING user_id
+        ), counted AS (
+            UPDATE users SET post_count = users.post_count + authors.posts
+            FROM (SELECT user_id, count(*) AS posts FROM inserted GROUP BY user_id) AS authors
+            WHERE users.id = authors.user_id
+            RETURNING authors.posts
+        )
+        SELECT CAST(coalesce(sum(posts), 0) AS BIGINT) FROM counted
+    ''')).scalar()
+
+def import_users(connection,staging,columns):
+    '''
+    Insert the staged users with their password hashes, written as hex by the export. Users whose username or
+    email is already taken are skipped. Returns the number of users inserted
+    '''
+    return connection.execute(text(f'''
+        INSERT INTO users (username, email, password, admin_status)
+        SELECT {columns['username']}, {columns['email']}, CAST({columns['password']} AS BYTEA),
+            CAST({columns['admin_status']} AS BOOLEAN)
+        FROM {staging} AS staged
+        ON CONFLICT DO NOTHING
+    ''')).rowcount
+
+def bulk_import(engine,table,file,file_format):
+    '''
+    Load a CSV or JSON lines file into table in one transaction: COPY it into a staging table, then insert the
+    staged rows with a single INSERT ... SELECT. Memory use does not depend on the size of the file.
+    Returns the number of rows read and inserted
+    '''
+    try:
+        with engine.begin() as connection:
+            # COPY of millions of rows runs longer than the statement timeout meant for requests
+            connection.execute(text('SET LOCAL statement_timeout = 0'))
+            staging,columns = stage_rows(connection,table,file,file_format)
+            staged = connection.execute(text(f'SELECT count(*) FROM {staging} AS staged')).scalar()
+            click.echo(f'Staged {staged} {table}, inserting',err=True)
+            if table == 'posts':
+                inserted = import_posts(connection,staging,columns)
+                # Count the change so every worker drops its cached feed pages and clients refetch
+                connection.execute(text('''UPDATE feed_version SET version = version + 1, changed_at = :now
+                    WHERE id = 1'''),{'now':datetime.utcnow()})
+            else:
+                inserted = import_users(connection,staging,columns)
+    except(sqlalchemy_exceptions.DBAPIError) as error:
+        raise click.ClickException(f'Nothing was imported: {str(error.orig).strip()}') from error
+    return staged,inserted
+
+def bulk_export(engine,table,file,file_format):
+    '''
+    Dump table into a CSV or JSON lines file with COPY ... TO STDOUT, streamed BULK_CHUNK_SIZE bytes at a time.
+    Returns the number of rows written
+    '''
+    if file_format == 'jsonl':
+        copy = f'COPY (SELECT row_to_json(row) FROM ({BULK_EXPORTS[table]}) AS row) TO STDOUT WITH {JSONL_COPY_OPTIONS}'
+    else:
+        copy = f'COPY ({BULK_EXPORTS[table]}) TO STDOUT WITH (FORMAT csv, HEADER)'
+    with engine.begin() as connection:
+        connection.execute(text('SET LOCAL statement_timeout = 0'))
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(copy,CopyProgress(file,f'Wrote {table}'),BULK_CHUNK_SIZE)
+        return cursor.rowcount
+
+def database_engine():
+    '''
+    Engine of the Flask-SQLAlchemy extension bound to the current application
+    '''
+    return current_app.extensions['sqlalchemy'].db.engine
+
+def bulk_cli(table):
+    '''
+    Command group with the import and export commands of table, run against the database of the application
+    '''
+    group = AppGroup(table,help=f'Bulk load and dump {table}.')
+    format_option = click.option('--format','file_format',type=click.Choice(('csv','jsonl')),
+        help='File format, taken from the file extension by default.')
+
+    @group.command('import')
+    @click.argument('file',type=click.File('rb'))
+    @format_option
+    def import_command(file,file_format):
+        '''
+        Load a CSV or JSON lines file, - reads stdin
+        '''
+        staged,inserted = bulk_import(database_engine(),table,file,bulk_format(file,file_format))
+        current_app.extensions['feed_cache'].invalidate()
+        click.echo(f'Imported {inserted} of {staged} {table}, skipped {staged - inserted}')
+
+    @group.command('export')
+    @click.argument('file',type=click.File('wb'))
+    @format_option
+    def export_command(file,file_format):
+        '''
+        Dump every row to a CSV or JSON lines file, - writes stdout
+        '''
+        rows = bulk_export(database_engine(),table,file,bulk_format(file,file_format))
+        click.echo(f'Exported {rows} {table}',err=True)
+
+    return group
+
+posts_cli = bulk_cli('posts')
+users_cli = bulk_cli('users')
@@ -0,0 +1,42 @@
+'''
+Gunicorn configuration for serving the blog in production with 'gunicorn -c gunicorn.conf.py app:app'.
+Each worker process runs a pool of threads, so requests waiting on the database do not hold a whole process.
+Every setting can be overridden from the environment. Send SIGHUP to the master process to reload the code and
+configuration gracefully: new workers are started and the old ones finish their requests before they exit.
+'''
+import multiprocessing
+import os
+
+cores = multiprocessing.cpu_count()
+
+bind = os.environ.get('GUNICORN_BIND','0.0.0.0:4000')
+
+# One worker process per core, each with a few threads for requests blocked on I/O
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY',cores))
+threads = int(os.environ.get('GUNICORN_THREADS',4))
+
+# Keep connections from the load balancer open between requests
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE',5))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT',30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT',30))
+
+# Recycle workers after a number of requests to bound memory growth, 0 never recycles them
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS',0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER',0))
+
+# Each worker builds its own app after the fork so thread pools are never shared across processes and a
+# SIGHUP reload picks up new code
+preload_app = False
+
+# Heartbeat files on a memory backed filesystem, docker's overlay filesystem can stall workers
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+errorlog = os.environ.get('GUNICORN_ERROR_LOG','-')
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL','info')
+
+# Split the cores between the bcrypt pools of the workers instead of giving every worker one thread per core
+raw_env = []
+if 'HASH_WORKERS' not in os.environ:
+    raw_env.append(f'HASH_WORKERS={max(1,cores // workers)}')
@@ -0,0 +1,192 @@
+'''
+Versioned schema migrations for the blog database.
+Each migration has a version number, a description and the SQL statements that upgrade the schema to that version
+and downgrade it back to the previous one. The version the database is at is kept in the schema_version table.
+Migrations run inside one transaction holding an advisory lock, so several workers starting together can not
+apply the same migration twice.
+'''
+from typing import NamedTuple
+from sqlalchemy import text
+
+# Arbitrary key of the advisory lock taken while migrating
+MIGRATION_LOCK_ID = 74201
+
+class Migration(NamedTuple):
+    '''
+    One schema version with the statements that upgrade to it and downgrade from it
+    '''
+    version: int
+    description: str
+    upgrade: tuple
+    downgrade: tuple
+
+MIGRATIONS = (
+    Migration(
+        version=1,
+        description='Create the users and posts tables',
+        # IF NOT EXISTS adopts databases created by db.create_all() before migrations existed
+        upgrade=(
+            '''CREATE TABLE IF NOT EXISTS users (
+                id SERIAL PRIMARY KEY,
+                username VARCHAR(30) NOT NULL UNIQUE,
+                password BYTEA NOT NULL,
+                email VARCHAR(40) NOT NULL UNIQUE,
+                admin_status BOOLEAN
+            )''',
+            '''CREATE TABLE IF NOT EXISTS posts (
+                id SERIAL PRIMARY KEY,
+                title VARCHAR(65) NOT NULL,
+                body VARCHAR(500) NOT NULL,
+                user_id INTEGER REFERENCES users (id),
+                timestamp DATE NOT NULL
+            )''',
+        ),
+        downgrade=(
+            'DROP TABLE posts',
+            'DROP TABLE users',
+        ),
+    ),
+    Migration(
+        version=2,
+        description='Index posts by feed order and by owner',
+        upgrade=(
+            'CREATE INDEX IF NOT EXISTS ix_posts_timestamp_id ON posts (timestamp DESC, id DESC)',
+            'CREATE INDEX IF NOT EXISTS ix_posts_user_id_timestamp ON posts (user_id, timestamp DESC, id DESC)',
+        ),
+        downgrade=(
+            'DROP INDEX ix_posts_user_id_timestamp',
+            'DROP INDEX ix_posts_timestamp_id',
+        ),
+    ),
+    Migration(
+        version=3,
+        description='Shared store of revoked tokens',
+        upgrade=(
+            '''CREATE TABLE IF NOT EXISTS revoked_tokens (
+                jti VARCHAR(32) PRIMARY KEY,
+                expires_at TIMESTAMP NOT NULL,
+                revoked_at TIMESTAMP NOT NULL DEFAULT now()
+            )''',
+            'CREATE INDEX IF NOT EXISTS ix_revoked_tokens_revoked_at ON revoked_tokens (revoked_at)',
+            'CREATE INDEX IF NOT EXISTS ix_revoked_tokens_expires_at ON revoked_tokens (expires_at)',
+        ),
+        downgrade=(
+            'DROP TABLE revoked_tokens',
+        ),
+    ),
+    Migration(
+        version=4,
+        description='Full text search over post titles and bodies',
+        upgrade=(
+            '''ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector TSVECTOR GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', title), 'A') || setweight(to_tsvector('english', body), 'B')
+            ) STORED''',
+            'CREATE INDEX IF NOT EXISTS ix_posts_search_vector ON posts USING gin (search_vector)',
+        ),
+        downgrade=(
+            'DROP INDEX ix_posts_search_vector',
+            'ALTER TABLE posts DROP COLUMN search_vector',
+        ),
+    ),
+    Migration(
+        version=5,
+        description='Count changes to posts for conditional requests',
+        upgrade=(
+            '''CREATE TABLE IF NOT EXISTS feed_version (
+                id INTEGER PRIMARY KEY,
+                version BIGINT NOT NULL,
+                changed_at TIMESTAMP
+            )''',
+            'INSERT INTO feed_version (id, version) VALUES (1, 0) ON CONFLICT DO NOTHING',
+        ),
+        downgrade=(
+            'DROP TABLE feed_version',
+        ),
+    ),
+    Migration(
+        version=6,
+        description='Index usernames and emails for prefix search',
+        upgrade=(
+            'CREATE INDEX IF NOT EXISTS ix_users_username_prefix ON users (username varchar_pattern_ops)',
+            'CREATE INDEX IF NOT EXISTS ix_users_email_prefix ON users (email varchar_pattern_ops)',
+        ),
+        downgrade=(
+            'DROP INDEX ix_users_email_prefix',
+            'DROP INDEX ix_users_username_prefix',
+        ),
+    ),
+    Migration(
+        version=7,
+        description='Keep a post count on each user for author pages',
+        upgrade=(
+            'ALTER TABLE users ADD COLUMN IF NOT EXISTS post_count INTEGER NOT NULL DEFAULT 0',
+            'UPDATE users SET post_count = (SELECT count(*) FROM posts WHERE posts.user_id = users.id)',
+        ),
+        downgrade=(
+            'ALTER TABLE users DROP COLUMN post_count',
+        ),
+    ),
+    Migration(
+        version=8,
+        description='Shared store of login and registration rate limits',
+        upgrade=(
+            '''CREATE TABLE IF NOT EXISTS rate_limits (
+                bucket VARCHAR(255) PRIMARY KEY,
+                full_at DOUBLE PRECISION NOT NULL
+            )''',
+            'CREATE INDEX IF NOT EXISTS ix_rate_limits_full_at ON rate_limits (full_at)',
+        ),
+        downgrade=(
+            'DROP TABLE rate_limits',
+        ),
+    ),
+)
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+def _lock(connection):
+    '''
+    Create the schema_version table if needed, take the migration lock and return the current version
+    '''
+    connection.execute(text('SELECT pg_advisory_xact_lock(:lock_id)'),{'lock_id':MIGRATION_LOCK_ID})
+    connection.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+    return connection.execute(text('SELECT max(version) FROM schema_version')).scalar() or 0
+
+def _set_version(connection,version):
+    connection.execute(text('DELETE FROM schema_version'))
+    connection.execute(text('INSERT INTO schema_version (version) VALUES (:version)'),{'version':version})
+
+def current_version(engine):
+    '''
+    The schema version the database is at, 0 for an empty database
+    '''
+    with engine.begin() as connection:
+        return _lock(connection)
+
+def upgrade(engine,target=LATEST_VERSION):
+    '''
+    Apply every migration above the current version up to target. Returns the version the database ends at
+    '''
+    with engine.begin() as connection:
+        version = _lock(connection)
+        for migration in MIGRATIONS:
+            if version < migration.version <= target:
+                for statement in migration.upgrade:
+                    connection.execute(text(statement))
+                version = migration.version
+        _set_version(connection,version)
+    return version
+
+def downgrade(engine,target):
+    '''
+    Revert every migration above target, newest first. Returns the version the database ends at
+    '''
+    with engine.begin() as connection:
+        version = _lock(connection)
+        for migration in reversed(MIGRATIONS):
+            if target < migration.version <= version:
+                for statement in migration.downgrade:
+                    connection.execute(text(statement))
+                version = migration.version - 1
+        _set_version(connection,version)
+    return version